@@ -14,44 +14,76 @@ from dash import html
 from dash.dependencies import Input, Output
 from dash import dash_table
 import dash_bootstrap_components as dbc
+from dash.exceptions import PreventUpdate
+from flask import jsonify, request
 import os
+import uuid
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+
+from aggregates import AggregateCube
+import chunked_aggregates
+import crossfilter
+from figures import FigureCache
+import layout_cache
+import metrics
+import profiling
+import asset_pipeline
+import clientside_charts
+import ingest
+import sketches
+import bulk_scoring
+import inference_pool
+from prediction_store import PredictionStore
+from snapshot import load_table
 
 import torch
-from transformers import BertTokenizer, BertModel
-from torch import nn
-
-class BERTClassifier(nn.Module):
-    def __init__(self, bert_model_name, num_classes):
-        super(BERTClassifier, self).__init__()
-        self.bert = BertModel.from_pretrained(bert_model_name)
-        self.dropout = nn.Dropout(0.1)
-        self.fc = nn.Linear(self.bert.config.hidden_size, num_classes)
-
-    def forward(self, input_ids, attention_mask):
-        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
-        pooled_output = outputs.pooler_output
-        x = self.dropout(pooled_output)
-        logits = self.fc(x)
-        return logits
+from transformers import BertTokenizerFast
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-bert_model_name = 'bert-base-uncased'
-tokenizer = BertTokenizer.from_pretrained(bert_model_name)
+from model_loader import ModelLoader
+from inference import RESULT_TIMEOUT, CachedTokenizer, InferenceEngine, LatestRequestTracker, PredictionCache, classify_batch, load_classifier, prepare_model
 
-model = BERTClassifier(bert_model_name, 2)
-model.load_state_dict(torch.load("bert_classifier.pth",  map_location=torch.device('cpu')))
-#model.to(device)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# overridable so benchmarks can run offline against a small local model
+bert_model_name = os.environ.get('BERT_MODEL_NAME', 'bert-base-uncased')
+bert_checkpoint = os.environ.get('BERT_CHECKPOINT', 'bert_classifier.pth')
+
+# Behind the cache, predictions shared by every worker on the host and kept across restarts, for this
+# checkpoint and INFERENCE_MODE only (PREDICTION_STORE, see prediction_store.py)
+prediction_store = PredictionStore()
+
+def load_inference_engine():
+    # INFERENCE_MODE picks fp32 (default), int8 (dynamically quantized) or compiled (TorchScript)
+    mode = os.environ.get('INFERENCE_MODE', 'fp32')
+    # first, since it can mean hashing the checkpoint: the store serves lines as soon as it's open,
+    # before the weights are in
+    prediction_store.open(bert_checkpoint, mode)
+    # Rust tokenizer (same ids as BertTokenizer, checked by benchmarks/check_tokenizer.py) with a cache of encoded ids
+    tokenizer = CachedTokenizer(BertTokenizerFast.from_pretrained(bert_model_name))
+    model = load_classifier(bert_checkpoint, bert_model_name)
+    if inference_pool.ENABLED:
+        # INFERENCE_PROCESSES worker processes sharing one mapped copy of the weights (see inference_pool.py)
+        return inference_pool.InferencePool.from_env(model, tokenizer, device, mode)
+    model = prepare_model(model, mode)
+    #model.to(device)
+    # Batches the opening lines of everyone typing at once into shared forward passes.
+    # Tuned with INFERENCE_MAX_BATCH_SIZE and INFERENCE_MAX_WAIT_MS.
+    return InferenceEngine.from_env(model, tokenizer, device)
+
+# ~440MB of weights load in the background so the dashboard is served while the model warms up
+classifier = ModelLoader('bert_classifier', load_inference_engine)
+classifier.start()
+
+# Every keystroke fires update_output: repeated text is answered from the cache, and text a session
+# has already typed past is dropped before it reaches the model
+prediction_cache = PredictionCache(maxsize=4096, ttl=3600)
+in_flight = LatestRequestTracker()
+
+def sentiment_message(pred):
+    return "Congratulations, you will likely get a response!" if pred == 1 else "Sorry, better luck next time...you have been ignored :( "
 
 def predict_sentiment(text, model, tokenizer, device, max_length=128):
-    model.eval()
-    encoding = tokenizer(text, return_tensors='pt', max_length=max_length, padding='max_length', truncation=True)
-    input_ids = encoding['input_ids'].to(device)
-    attention_mask = encoding['attention_mask'].to(device)
-
-    with torch.no_grad():
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-        _, preds = torch.max(outputs, dim=1)
-    return "Congratulations, you will likely get a response!" if preds.item() == 1 else "Sorry, better luck next time...you have been ignored :( "
+    pred, _ = classify_batch([text], model, tokenizer, device, max_length)[0]
+    return sentiment_message(pred)
 
 #from PIL import Image # new import
 external_stylesheets = [dbc.themes.MORPH,
@@ -72,9 +104,10 @@ external_stylesheets = [dbc.themes.MORPH,
 ####################################DATA MANIPULATION PREPPING FOR DASHBOARD#################################################
 #############################################################################################################################
 
-df=pd.read_csv("./Data/descriptive_stats.csv")
-df_datingapps=pd.read_csv("./Data/datingapps_downloads.csv")
-df_datingtrends=pd.read_csv("./Data/datingtrends.csv")
+# Typed columnar snapshots built by `python snapshot.py` (falls back to the CSVs when they are stale)
+df=load_table("descriptive_stats")
+df_datingapps=load_table("datingapps_downloads")
+df_datingtrends=load_table("datingtrends")
 
 dating_trends_melt=pd.melt(df_datingtrends, id_vars =['Category'], value_vars =['1995', '2017'])
 dating_trend_fig = px.bar(dating_trends_melt, x="variable", y="value", color="Category", title="How couples meet").update_layout(
@@ -124,6 +157,26 @@ downloads_fig.update_yaxes(title_text='Downloads(in millions)')
 #     )
 # )
 
+# Group means for every dropdown dimension, computed once so the chart callbacks never scan df.
+# With AGGREGATES_SOURCE set they are streamed from that (possibly much larger) table in chunks instead.
+if chunked_aggregates.SOURCE:
+    aggregate_cube = chunked_aggregates.build_cube(chunked_aggregates.SOURCE, chunked_aggregates.WORKERS)
+else:
+    aggregate_cube = AggregateCube(df)
+figure_cache = FigureCache(maxsize=64)
+
+# Per-category row indexes behind the chart filters, which need df's rows and server-side charts
+if crossfilter.ENABLED and not clientside_charts.ENABLED and not chunked_aggregates.SOURCE:
+    crossfilter_index = crossfilter.CrossfilterIndex(df)
+else:
+    crossfilter_index = None
+
+# Rows dropped into INGEST_DIR after descriptive_stats.csv was built are folded into the cube as they arrive
+if ingest.ENABLED:
+    ingest_watcher = ingest.start(aggregate_cube, [crossfilter_index.update] if crossfilter_index is not None else [])
+else:
+    ingest_watcher = None
+
 avg_match_rate_by_gender = df.groupby('gender')['AverageMatchRate'].mean()
 avg_match_rate_by_sexuality = df.groupby('sexuality')['AverageMatchRate'].mean()
 
@@ -131,8 +184,8 @@ genders = df["gender"].sort_values().unique()
 print(genders)
 
 
-male_emojis=pd.read_csv("./Data/male_emojis.csv")
-female_emojis=pd.read_csv("./Data/female_emojis.csv")
+male_emojis=load_table("male_emojis")
+female_emojis=load_table("female_emojis")
 fig_emojis = make_subplots(rows=2, cols=1,subplot_titles=("Male: most used emojis", "Female: most used emojis"))
 
 
@@ -144,6 +197,11 @@ fig_emojis.add_trace(fig2['data'][0], row=2, col=1)
 ## App instance
 dash_app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app = dash_app.server
+# content-hashed, resized images built by `python asset_pipeline.py`
+asset_pipeline.install(app)
+# opt-in sampling profiles of callbacks (only with PROFILE_TOKEN set), and metrics at /metrics
+profiling.install(dash_app)
+metrics.install(dash_app)
 
 
 #############################################################################################################################
@@ -151,27 +209,27 @@ app = dash_app.server
 #############################################################################################################################
 header= [
         #html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-                html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+                asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
         html.H1(children="Tinder Data Dive", style={"fontSize": "80px", "color": "#ff9999", "text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
         html.H3(
             children=(
                 "A dashboard that analyses the trends, statistics and "
@@ -194,6 +252,10 @@ column2=[
 
 
 dash_app.layout = html.Div(    [
+        # per-group means for the charts drawn in the browser (only with CLIENTSIDE_CHARTS=1)
+        *([clientside_charts.store(aggregate_cube)] if clientside_charts.ENABLED else []),
+        # polls for ingested rows (only with INGEST_DIR set)
+        *(ingest.layout(aggregate_cube) if ingest.ENABLED else []),
         dbc.Row(dbc.Col(header )),
         dbc.Row(
             [
@@ -211,12 +273,16 @@ dash_app.layout = html.Div(    [
                 html.H3("Swipes",style={"text-align":"center"}),
                 html.P("One of the most interesting piece of statistics is how discerning a tinder user is. Do they rarely swipe right? Or will their hands likely develop RSI from all the repetitive movements? And how different is that for different demographics? "),
                 dcc.Dropdown(['gender','sexuality','AgeofUserGroup','educationLevel'],id='swipe-rate-dropdown',value='gender'),
+                *([crossfilter.controls('swipe', crossfilter_index)] if crossfilter_index is not None else []),
+                *([sketches.mode_control('swipe')] if not clientside_charts.ENABLED else []),
                 dcc.Graph(id="swipe-rate-chart"),
                 html.Label(), 
                 html.Br(),
                 html.H3("Matches",style={"text-align":"center"}),
                 html.P("Of course, when one looks at Tinder, one of the key things people care about is match rate - how many swipes are needed before there is a match? Is there a difference between male and female?"),
                 dcc.Dropdown(['gender','sexuality','AgeofUserGroup','educationLevel'],id='match-rate-dropdown',value='gender'),
+                *([crossfilter.controls('match', crossfilter_index)] if crossfilter_index is not None else []),
+                *([sketches.mode_control('match')] if not clientside_charts.ENABLED else []),
                 dcc.Graph(id="match-rate-chart"),
       ]),
 
@@ -224,7 +290,7 @@ dash_app.layout = html.Div(    [
                 dbc.Col([html.Br(),
                         html.H3("Messages",style={"text-align":"center"}),       
                          html.P("This dataset also includes annonymised messages from every user in this dataset. Some very interesting insights from the messages data can be drawn!"),
-                         html.Img(src=dash.get_asset_url('chat_convo.png'),style={'height':'20%', 'width':'85%',"text-align":"center"}),
+                         asset_pipeline.picture('chat_convo.png', style={'height':'20%', 'width':'85%',"text-align":"center"}),
                             html.P("Note: only messages sent by the user is available, messages sent to the user is not within our dataset."),
                             html.Br(),
                             html.H3("Word clouds",style={"text-align":"center"}), 
@@ -232,10 +298,10 @@ dash_app.layout = html.Div(    [
                             html.Div([
     dcc.Tabs([
         dcc.Tab(label='Male', children=[
-            html.Img(src=dash.get_asset_url('word_cloud_gender_M.png'), style={'height':'85%', 'width':'95%'}),
+            asset_pipeline.picture('word_cloud_gender_M.png', style={'height':'85%', 'width':'95%'}),
         ]),
         dcc.Tab(label='Female', children=[
-            html.Img(src=dash.get_asset_url('word_cloud_gender_F.png'), style={'height':'95%', 'width':'105%'}),
+            asset_pipeline.picture('word_cloud_gender_F.png', style={'height':'95%', 'width':'105%'}),
         ]),
     ])
 ]),
@@ -280,41 +346,92 @@ dash_app.layout = html.Div(    [
     ],
 )
 
+# The layout is static, so serialize and compress it once instead of on every page load
+precompressed_layout = layout_cache.install(dash_app)
+
 #############################################################################################################################
 ################################################### CALLBACKS ###############################################################
 #############################################################################################################################
 
-@dash_app.callback(
-        
 #Defining the output objects, identifying the element and property of the element to be modified
-#For example, Output("price-chart", "figure") will update the figure property of the "price-chart" element
-    Output("match-rate-chart", "figure"),
-    Output("swipe-rate-chart", "figure"),
-    
+#For example, Output("match-rate-chart", "figure") will update the figure property of the "match-rate-chart" element
+#Input('match-rate-dropdown', "value") will watch the dropdown and pass its new value on to the callback function.
+#Each chart has its own callback so changing one dropdown doesn't rebuild the other chart, and figures are
+#served from figure_cache so a selection seen before never goes back through plotly express.
+#With ingestion on, the charts also redraw when ingest.ROWS_ID reports new rows in aggregate_cube.
+#Filtered charts are grouped from crossfilter_index instead, over just the selected rows.
+#The chart mode radio switches between means and percentiles, box plots or histograms drawn from the
+#mergeable distribution sketches of sketches.py, so none of them goes back to the rows either.
 
-#Input("region-filter", "value") will watch the "region-filter" element and its value property for changes. The argument
-#  passed on to the callback function will be the new value of region-filter.value
-    Input('match-rate-dropdown', "value"),
-    Input('swipe-rate-dropdown', "value"),
-    )
+def rate_chart(metric, dimension, filter_values, mode='mean'):
+    filters = crossfilter.selection(crossfilter_index.dimensions, filter_values) if crossfilter_index is not None else None
+    if filters is None:
+        return figure_cache.figure(aggregate_cube, metric, dimension, mode=mode)
+    return figure_cache.figure(crossfilter_index, metric, dimension, filters, mode)
 
-# you define the function that’ll be applied when an input changes. It’s worth noticing that the arguments of the function will 
-# correspond with the order of the Input objects supplied to the callback. There’s no explicit relationship between the names of the arguments in the function and the values specified in the Input objects.
 
-#Finally, on lines 14 to 54, you define the body of the function. In this case, the function takes the inputs (region, type of avocado,
-#  and date range), filters the data, and generates the figure objects for the price and volume charts.
+def update_match_chart(match_value, filter_values=None, ingested_rows=None, mode='mean'):
+    return rate_chart('AverageMatchRate', match_value, filter_values, mode)
 
-def update_charts(match_value,swipe_value):
-    avg_match_rate_by_filter = df.groupby(match_value)['AverageMatchRate'].mean()
-    match_rate_fig = px.bar(avg_match_rate_by_filter, x=avg_match_rate_by_filter.index, y=avg_match_rate_by_filter.values, color=avg_match_rate_by_filter.index, title='Match rate percentage by groups')
-    match_rate_fig.layout.yaxis.tickformat = ',.0%'
-    match_rate_fig.update_yaxes(title_text='Match rate percentage')
-    
-    avg_swipe_rate_by_filter = df.groupby(swipe_value)['AveragePercentageSwipeRight'].mean()
-    swipe_rate_fig = px.bar(avg_swipe_rate_by_filter, x=avg_swipe_rate_by_filter.index, y=avg_swipe_rate_by_filter.values, color=avg_swipe_rate_by_filter.index, title='Rate of swiping "Right"')
-    swipe_rate_fig.layout.yaxis.tickformat = ',.0%'
-    swipe_rate_fig.update_yaxes(title_text='Swipe right percentage')
-    return match_rate_fig, swipe_rate_fig
+
+def update_swipe_chart(swipe_value, filter_values=None, ingested_rows=None, mode='mean'):
+    return rate_chart('AveragePercentageSwipeRight', swipe_value, filter_values, mode)
+
+
+def chart_inputs(value_name, dropdown_id, prefix):
+    inputs = {value_name: Input(dropdown_id, "value")}
+    if crossfilter_index is not None:
+        inputs['filter_values'] = crossfilter.filter_input(prefix)
+    if ingest.ENABLED:
+        inputs['ingested_rows'] = Input(ingest.ROWS_ID, 'data')
+    inputs['mode'] = sketches.mode_input(prefix)
+    return inputs
+
+
+if ingest.ENABLED:
+    ingest.register(dash_app, ingest_watcher)
+
+if clientside_charts.ENABLED:
+    # drawn in the browser from the aggregates in the layout, no request reaches the server
+    clientside_charts.register(dash_app, [
+        ("match-rate-chart", 'match-rate-dropdown', 'AverageMatchRate'),
+        ("swipe-rate-chart", 'swipe-rate-dropdown', 'AveragePercentageSwipeRight'),
+    ], aggregate_cube, refresh=Input(ingest.ROWS_ID, 'data') if ingest.ENABLED else None)
+else:
+    dash_app.callback(Output("match-rate-chart", "figure"), inputs=chart_inputs('match_value', 'match-rate-dropdown', 'match'))(update_match_chart)
+    dash_app.callback(Output("swipe-rate-chart", "figure"), inputs=chart_inputs('swipe_value', 'swipe-rate-dropdown', 'swipe'))(update_swipe_chart)
+
+
+# Hit/miss counters of the chart figure cache
+@app.route('/figure-cache-stats')
+def figure_cache_stats():
+    return jsonify(figure_cache.info())
+
+
+# Hit/miss counters of the in-process prediction cache and the shared prediction store
+@app.route('/prediction-cache-stats')
+def prediction_cache_stats():
+    return jsonify(cache=prediction_cache.info(), store=prediction_store.info())
+
+
+# Always 200 once the dashboard is up, so health checks pass while the model is still warming up;
+# the model state is reported alongside. 503 only if loading the model failed.
+@app.route('/ready')
+def ready():
+    status = classifier.status()
+    return jsonify(dashboard='ready', model=status), 503 if status['state'] == 'failed' else 200
+
+
+# POST /score rates many opening lines at once, streaming results back as they are scored
+bulk_scoring.install(app, classifier)
+
+
+def opening_line_session():
+    session_id = request.cookies.get('opening-line-session')
+    if session_id is None:
+        session_id = uuid.uuid4().hex
+        dash.callback_context.response.set_cookie('opening-line-session', session_id, httponly=True, samesite='Lax')
+    return session_id
 
 
 @dash_app.callback(
@@ -322,7 +439,31 @@ def update_charts(match_value,swipe_value):
     Input('textarea-example', 'value')
 )
 def update_output(value):
-    sentiment = predict_sentiment(value, model, tokenizer, device)
+    result = prediction_cache.get(value)
+    if result is None:
+        result = prediction_store.get(value)
+        if result is not None:
+            prediction_cache.put(value, result)
+    if result is None:
+        if not classifier.ready:
+            return 'The opening line rater is still warming up, try again in a moment!'
+        session_id = opening_line_session()
+        future = classifier.get().submit(value)
+        in_flight.replace(session_id, future)
+        try:
+            result = future.result(RESULT_TIMEOUT)
+        except CancelledError:
+            # newer text from the same session has replaced this one
+            raise PreventUpdate
+        except FutureTimeoutError:
+            future.cancel()
+            return 'The opening line rater is taking too long, try again in a moment!'
+        finally:
+            in_flight.finish(session_id, future)
+        prediction_cache.put(value, result)
+        prediction_store.put(value, result)
+    pred, _ = result
+    sentiment = sentiment_message(pred)
     return 'You will get a response of: \n{}'.format(sentiment)
 
 
@@ -0,0 +1,92 @@
+# Precomputed aggregates for the swipe rate and match rate charts
+
+import threading
+
+import pandas as pd
+
+from sketches import DistributionCube
+
+# Every column offered in the swipe/match dropdowns and the metrics plotted against them
+DIMENSIONS = ['gender', 'sexuality', 'AgeofUserGroup', 'educationLevel', 'ProfileShowsSchool', 'ProfileShowsJob']
+METRICS = ['AverageMatchRate', 'AveragePercentageSwipeRight']
+
+
+class AggregateCube:
+    """Sum/count/mean of every metric for every group of every dimension.
+
+    Built once from the user table so callbacks only look up a handful of groups
+    instead of re-running a groupby over all the rows. update() folds in new rows
+    and bumps version, which caches of anything derived from the cube key on.
+    distributions holds a sketch of each group's values, for quantiles and histograms.
+    """
+
+    def __init__(self, df, dimensions=DIMENSIONS, metrics=METRICS):
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        self.version = 0
+        self.rows = len(df)
+        self.tables = {dimension: self._aggregate(df, dimension) for dimension in self.dimensions}
+        self.distributions = DistributionCube(df, self.dimensions, self.metrics)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_tables(cls, tables, rows, metrics=METRICS, distributions=None):
+        """A cube over sum/count tables (and sketches) aggregated elsewhere, e.g. by chunked_aggregates."""
+        cube = cls.__new__(cls)
+        cube.dimensions = list(tables)
+        cube.metrics = list(metrics)
+        cube.version = 0
+        cube.rows = rows
+        cube.tables = {dimension: cube._with_means(table) for dimension, table in tables.items()}
+        cube.distributions = distributions if distributions is not None else DistributionCube(None, cube.dimensions, cube.metrics)
+        cube._lock = threading.Lock()
+        return cube
+
+    def _aggregate(self, df, dimension):
+        table = df.groupby(dimension, observed=True)[self.metrics].agg(['sum', 'count'])
+        if isinstance(table.index, pd.CategoricalIndex):
+            # plain labels, so charts and lookups behave the same whichever way df was loaded
+            table.index = table.index.astype(table.index.categories.dtype)
+        return self._with_means(table)
+
+    def _with_means(self, table):
+        for metric in self.metrics:
+            table[(metric, 'mean')] = table[(metric, 'sum')] / table[(metric, 'count')]
+        return table
+
+    def update(self, df):
+        """Add the rows of df to the running sums and counts, grouping only df.
+
+        Tables are replaced rather than modified, and before version changes, so a
+        reader never sees a half-applied update.
+        """
+        if len(df) == 0:
+            return self.version
+        with self._lock:
+            tables = {}
+            for dimension, table in self.tables.items():
+                partial = self._aggregate(df, dimension)
+                columns = [(metric, agg) for metric in self.metrics for agg in ('sum', 'count')]
+                merged = table[columns].add(partial[columns], fill_value=0)
+                for metric in self.metrics:
+                    # float64 running sums, so many small updates don't accumulate float32 rounding
+                    merged[(metric, 'sum')] = merged[(metric, 'sum')].astype('float64')
+                    merged[(metric, 'count')] = merged[(metric, 'count')].astype('int64')
+                tables[dimension] = self._with_means(merged)
+            self.tables = tables
+            self.distributions.update(df)
+            self.rows += len(df)
+            self.version += 1
+            return self.version
+
+    def mean(self, dimension, metric):
+        """Same result as df.groupby(dimension)[metric].mean()."""
+        return self.tables[dimension][(metric, 'mean')].rename(metric)
+
+    def stats(self, dimension, metric):
+        """sum, count and mean columns for each group of the dimension."""
+        return self.tables[dimension][metric]
+
+    def bucket_counts(self, dimension, metric):
+        """(labels, sketch bucket counts) of metric for each group of the dimension, see sketches.py."""
+        return self.distributions.bucket_counts(dimension, metric)
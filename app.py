@@ -14,8 +14,22 @@ from dash import html
 from dash.dependencies import Input, Output
 from dash import dash_table
 import dash_bootstrap_components as dbc
+from flask import jsonify
 import os
 
+from aggregates import AggregateCube
+import chunked_aggregates
+import crossfilter
+from figures import FigureCache
+import layout_cache
+import metrics
+import profiling
+import asset_pipeline
+import clientside_charts
+import ingest
+import sketches
+from snapshot import load_table
+
 
 #from PIL import Image # new import
 external_stylesheets = [dbc.themes.MORPH,
@@ -36,9 +50,10 @@ external_stylesheets = [dbc.themes.MORPH,
 ####################################DATA MANIPULATION PREPPING FOR DASHBOARD#################################################
 #############################################################################################################################
 
-df=pd.read_csv("./Data/descriptive_stats.csv")
-df_datingapps=pd.read_csv("./Data/datingapps_downloads.csv")
-df_datingtrends=pd.read_csv("./Data/datingtrends.csv")
+# Typed columnar snapshots built by `python snapshot.py` (falls back to the CSVs when they are stale)
+df=load_table("descriptive_stats")
+df_datingapps=load_table("datingapps_downloads")
+df_datingtrends=load_table("datingtrends")
 
 dating_trends_melt=pd.melt(df_datingtrends, id_vars =['Category'], value_vars =['1995', '2017'])
 dating_trend_fig = px.bar(dating_trends_melt, x="variable", y="value", color="Category", title="How couples meet").update_layout(
@@ -88,6 +103,26 @@ downloads_fig.update_yaxes(title_text='Downloads(in millions)')
 #     )
 # )
 
+# Group means for every dropdown dimension, computed once so the chart callbacks never scan df.
+# With AGGREGATES_SOURCE set they are streamed from that (possibly much larger) table in chunks instead.
+if chunked_aggregates.SOURCE:
+    aggregate_cube = chunked_aggregates.build_cube(chunked_aggregates.SOURCE, chunked_aggregates.WORKERS)
+else:
+    aggregate_cube = AggregateCube(df)
+figure_cache = FigureCache(maxsize=64)
+
+# Per-category row indexes behind the chart filters, which need df's rows and server-side charts
+if crossfilter.ENABLED and not clientside_charts.ENABLED and not chunked_aggregates.SOURCE:
+    crossfilter_index = crossfilter.CrossfilterIndex(df)
+else:
+    crossfilter_index = None
+
+# Rows dropped into INGEST_DIR after descriptive_stats.csv was built are folded into the cube as they arrive
+if ingest.ENABLED:
+    ingest_watcher = ingest.start(aggregate_cube, [crossfilter_index.update] if crossfilter_index is not None else [])
+else:
+    ingest_watcher = None
+
 avg_match_rate_by_gender = df.groupby('gender')['AverageMatchRate'].mean()
 avg_match_rate_by_sexuality = df.groupby('sexuality')['AverageMatchRate'].mean()
 
@@ -95,8 +130,8 @@ genders = df["gender"].sort_values().unique()
 print(genders)
 
 
-male_emojis=pd.read_csv("./Data/male_emojis.csv")
-female_emojis=pd.read_csv("./Data/female_emojis.csv")
+male_emojis=load_table("male_emojis")
+female_emojis=load_table("female_emojis")
 fig_emojis = make_subplots(rows=2, cols=1,subplot_titles=("Male: most used emojis", "Female: most used emojis"))
 
 
@@ -108,6 +143,11 @@ fig_emojis.add_trace(fig2['data'][0], row=2, col=1)
 ## App instance
 dash_app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app = dash_app.server
+# content-hashed, resized images built by `python asset_pipeline.py`
+asset_pipeline.install(app)
+# opt-in sampling profiles of callbacks (only with PROFILE_TOKEN set), and metrics at /metrics
+profiling.install(dash_app)
+metrics.install(dash_app)
 
 
 #############################################################################################################################
@@ -115,27 +155,27 @@ app = dash_app.server
 #############################################################################################################################
 header= [
         #html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-                html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+                asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
         html.H1(children="Tinder Data Dive", style={"fontSize": "80px", "color": "#ff9999", "text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
-        html.Img(src=dash.get_asset_url('TinderPNG.png'),style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
+        asset_pipeline.picture('TinderPNG.png', style={'display':'inline-block','height':'20%', 'width':'10%',"text-align":"center"}),
         html.H3(
             children=(
                 "A dashboard that analyses the trends, statistics and "
@@ -158,6 +198,10 @@ column2=[
 
 
 dash_app.layout = html.Div(    [
+        # per-group means for the charts drawn in the browser (only with CLIENTSIDE_CHARTS=1)
+        *([clientside_charts.store(aggregate_cube)] if clientside_charts.ENABLED else []),
+        # polls for ingested rows (only with INGEST_DIR set)
+        *(ingest.layout(aggregate_cube) if ingest.ENABLED else []),
         dbc.Row(dbc.Col(header )),
         dbc.Row(
             [
@@ -175,12 +219,16 @@ dash_app.layout = html.Div(    [
                 html.H3("Swipes",style={"text-align":"center"}),
                 html.P("One of the most interesting piece of statistics is how discerning a tinder user is. Do they rarely swipe right? Or will their hands likely develop RSI from all the repetitive movements? And how different is that for different demographics? "),
                 dcc.Dropdown(['gender','sexuality','AgeofUserGroup','educationLevel','ProfileShowsSchool','ProfileShowsJob'],id='swipe-rate-dropdown',value='gender'),
+                *([crossfilter.controls('swipe', crossfilter_index)] if crossfilter_index is not None else []),
+                *([sketches.mode_control('swipe')] if not clientside_charts.ENABLED else []),
                 dcc.Graph(id="swipe-rate-chart"),
                 html.Label(), 
                 html.Br(),
                 html.H3("Matches",style={"text-align":"center"}),
                 html.P("Of course, when one looks at Tinder, one of the key things people care about is match rate - how many swipes are needed before there is a match? Is there a difference between male and female?"),
                 dcc.Dropdown(['gender','sexuality','AgeofUserGroup','educationLevel','ProfileShowsSchool','ProfileShowsJob'],id='match-rate-dropdown',value='gender'),
+                *([crossfilter.controls('match', crossfilter_index)] if crossfilter_index is not None else []),
+                *([sketches.mode_control('match')] if not clientside_charts.ENABLED else []),
                 dcc.Graph(id="match-rate-chart"),
       ]),
 
@@ -188,7 +236,7 @@ dash_app.layout = html.Div(    [
                 dbc.Col([html.Br(),
                         html.H3("Messages",style={"text-align":"center"}),       
                          html.P("This dataset also includes annonymised messages from every user in this dataset. Some very interesting insights from the messages data can be drawn!"),
-                         html.Img(src=dash.get_asset_url('chat_convo.png'),style={'height':'20%', 'width':'85%',"text-align":"center"}),
+                         asset_pipeline.picture('chat_convo.png', style={'height':'20%', 'width':'85%',"text-align":"center"}),
                             html.P("Note: only messages sent by the user is available, messages sent to the user is not within our dataset."),
                             html.Br(),
                             html.H3("Word clouds",style={"text-align":"center"}), 
@@ -196,10 +244,10 @@ dash_app.layout = html.Div(    [
                             html.Div([
     dcc.Tabs([
         dcc.Tab(label='Male', children=[
-            html.Img(src=dash.get_asset_url('word_cloud_gender_M.png'), style={'height':'85%', 'width':'95%'}),
+            asset_pipeline.picture('word_cloud_gender_M.png', style={'height':'85%', 'width':'95%'}),
         ]),
         dcc.Tab(label='Female', children=[
-            html.Img(src=dash.get_asset_url('word_cloud_gender_F.png'), style={'height':'95%', 'width':'105%'}),
+            asset_pipeline.picture('word_cloud_gender_F.png', style={'height':'95%', 'width':'105%'}),
         ]),
     ])
 ]),
@@ -233,41 +281,66 @@ dash_app.layout = html.Div(    [
     ],
 )
 
+# The layout is static, so serialize and compress it once instead of on every page load
+precompressed_layout = layout_cache.install(dash_app)
+
 #############################################################################################################################
 ################################################### CALLBACKS ###############################################################
 #############################################################################################################################
 
-@dash_app.callback(
-        
 #Defining the output objects, identifying the element and property of the element to be modified
-#For example, Output("price-chart", "figure") will update the figure property of the "price-chart" element
-    Output("match-rate-chart", "figure"),
-    Output("swipe-rate-chart", "figure"),
-    
-
-#Input("region-filter", "value") will watch the "region-filter" element and its value property for changes. The argument
-#  passed on to the callback function will be the new value of region-filter.value
-    Input('match-rate-dropdown', "value"),
-    Input('swipe-rate-dropdown', "value"),
-    )
-
-# you define the function that’ll be applied when an input changes. It’s worth noticing that the arguments of the function will 
-# correspond with the order of the Input objects supplied to the callback. There’s no explicit relationship between the names of the arguments in the function and the values specified in the Input objects.
-
-#Finally, on lines 14 to 54, you define the body of the function. In this case, the function takes the inputs (region, type of avocado,
-#  and date range), filters the data, and generates the figure objects for the price and volume charts.
-
-def update_charts(match_value,swipe_value):
-    avg_match_rate_by_filter = df.groupby(match_value)['AverageMatchRate'].mean()
-    match_rate_fig = px.bar(avg_match_rate_by_filter, x=avg_match_rate_by_filter.index, y=avg_match_rate_by_filter.values, color=avg_match_rate_by_filter.index, title='Match rate percentage by groups')
-    match_rate_fig.layout.yaxis.tickformat = ',.0%'
-    match_rate_fig.update_yaxes(title_text='Match rate percentage')
-    
-    avg_swipe_rate_by_filter = df.groupby(swipe_value)['AveragePercentageSwipeRight'].mean()
-    swipe_rate_fig = px.bar(avg_swipe_rate_by_filter, x=avg_swipe_rate_by_filter.index, y=avg_swipe_rate_by_filter.values, color=avg_swipe_rate_by_filter.index, title='Rate of swiping "Right"')
-    swipe_rate_fig.layout.yaxis.tickformat = ',.0%'
-    swipe_rate_fig.update_yaxes(title_text='Swipe right percentage')
-    return match_rate_fig, swipe_rate_fig
+#For example, Output("match-rate-chart", "figure") will update the figure property of the "match-rate-chart" element
+#Input('match-rate-dropdown', "value") will watch the dropdown and pass its new value on to the callback function.
+#Each chart has its own callback so changing one dropdown doesn't rebuild the other chart, and figures are
+#served from figure_cache so a selection seen before never goes back through plotly express.
+#With ingestion on, the charts also redraw when ingest.ROWS_ID reports new rows in aggregate_cube.
+#Filtered charts are grouped from crossfilter_index instead, over just the selected rows.
+#The chart mode radio switches between means and percentiles, box plots or histograms drawn from the
+#mergeable distribution sketches of sketches.py, so none of them goes back to the rows either.
+
+def rate_chart(metric, dimension, filter_values, mode='mean'):
+    filters = crossfilter.selection(crossfilter_index.dimensions, filter_values) if crossfilter_index is not None else None
+    if filters is None:
+        return figure_cache.figure(aggregate_cube, metric, dimension, mode=mode)
+    return figure_cache.figure(crossfilter_index, metric, dimension, filters, mode)
+
+
+def update_match_chart(match_value, filter_values=None, ingested_rows=None, mode='mean'):
+    return rate_chart('AverageMatchRate', match_value, filter_values, mode)
+
+
+def update_swipe_chart(swipe_value, filter_values=None, ingested_rows=None, mode='mean'):
+    return rate_chart('AveragePercentageSwipeRight', swipe_value, filter_values, mode)
+
+
+def chart_inputs(value_name, dropdown_id, prefix):
+    inputs = {value_name: Input(dropdown_id, "value")}
+    if crossfilter_index is not None:
+        inputs['filter_values'] = crossfilter.filter_input(prefix)
+    if ingest.ENABLED:
+        inputs['ingested_rows'] = Input(ingest.ROWS_ID, 'data')
+    inputs['mode'] = sketches.mode_input(prefix)
+    return inputs
+
+
+if ingest.ENABLED:
+    ingest.register(dash_app, ingest_watcher)
+
+if clientside_charts.ENABLED:
+    # drawn in the browser from the aggregates in the layout, no request reaches the server
+    clientside_charts.register(dash_app, [
+        ("match-rate-chart", 'match-rate-dropdown', 'AverageMatchRate'),
+        ("swipe-rate-chart", 'swipe-rate-dropdown', 'AveragePercentageSwipeRight'),
+    ], aggregate_cube, refresh=Input(ingest.ROWS_ID, 'data') if ingest.ENABLED else None)
+else:
+    dash_app.callback(Output("match-rate-chart", "figure"), inputs=chart_inputs('match_value', 'match-rate-dropdown', 'match'))(update_match_chart)
+    dash_app.callback(Output("swipe-rate-chart", "figure"), inputs=chart_inputs('swipe_value', 'swipe-rate-dropdown', 'swipe'))(update_swipe_chart)
+
+
+# Hit/miss counters of the chart figure cache
+@app.route('/figure-cache-stats')
+def figure_cache_stats():
+    return jsonify(figure_cache.info())
 
 
 
@@ -0,0 +1,137 @@
+# Build-time image pipeline for the pictures in assets/
+#
+# `python asset_pipeline.py` writes resized, recompressed variants of each image in IMAGES to
+# assets_build/: a palette PNG fallback, plus AVIF (when Pillow can encode it) and WebP where they beat
+# the PNG, at a few widths around the size each image is actually drawn at. File names carry a hash of
+# their content, so install() serves them with a one year immutable Cache-Control, and picture()
+# renders an html.Picture letting the browser pick the best format and width. Until the variants are built,
+# picture() falls back to the original file in assets/.
+
+import hashlib
+import io
+import json
+import os
+
+import dash
+from dash import html
+import flask
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(ROOT, 'assets')
+BUILD_DIR = os.path.join(ROOT, 'assets_build')
+MANIFEST = os.path.join(BUILD_DIR, 'manifest.json')
+URL_PREFIX = '/optimized/'
+
+# CSS width each image is drawn at (the root Div spans the viewport and the two columns split it
+# evenly) and the pixel widths to generate for it, covering phones up to 2x desktop displays
+IMAGES = {
+    'TinderPNG.png': {'sizes': '10vw', 'widths': (96, 192, 384)},
+    'chat_convo.png': {'sizes': '43vw', 'widths': (320, 480, 679)},
+    'word_cloud_gender_M.png': {'sizes': '48vw', 'widths': (400, 600, 800)},
+    'word_cloud_gender_F.png': {'sizes': '53vw', 'widths': (400, 600, 800)},
+}
+
+# most compact first, as the browser takes the first <source> it supports
+FORMATS = [
+    ('avif', 'image/avif', {'quality': 60}),
+    ('webp', 'image/webp', {'quality': 85, 'method': 6}),
+    ('png', 'image/png', {'optimize': True}),
+]
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _supported_formats():
+    from PIL import Image
+    Image.init()
+    return [fmt for fmt in FORMATS if fmt[0].upper() in Image.SAVE]
+
+
+def build():
+    from PIL import Image
+
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    manifest = {}
+    for name, spec in IMAGES.items():
+        source = Image.open(os.path.join(SOURCE_DIR, name))
+        source = source.convert('RGBA' if source.mode in ('P', 'LA', 'RGBA') else 'RGB')
+        stem = os.path.splitext(name)[0]
+        encoded = {}
+        for width in sorted({min(w, source.width) for w in spec['widths']}):
+            resized = source.resize((width, round(source.height * width / source.width)), Image.LANCZOS)
+            for ext, mimetype, options in _supported_formats():
+                image = resized
+                if ext == 'png':
+                    # these are flat-colour graphics, a 256 colour palette is visually lossless
+                    image = resized.quantize(256, method=Image.Quantize.FASTOCTREE)
+                buffer = io.BytesIO()
+                image.save(buffer, format=ext.upper(), **options)
+                encoded.setdefault((ext, mimetype), []).append((width, buffer.getvalue()))
+
+        # a modern format is only offered if it beats the PNG fallback at every width
+        png = dict(encoded[('png', 'image/png')])
+        variants = manifest[name] = []
+        for (ext, mimetype), items in encoded.items():
+            if ext != 'png' and any(len(data) >= len(png[width]) for width, data in items):
+                continue
+            for width, data in items:
+                filename = '{}.{}w.{}.{}'.format(stem, width, hashlib.sha256(data).hexdigest()[:12], ext)
+                with open(os.path.join(BUILD_DIR, filename), 'wb') as f:
+                    f.write(data)
+                variants.append({'file': filename, 'type': mimetype, 'width': width, 'bytes': len(data)})
+        original = os.path.getsize(os.path.join(SOURCE_DIR, name))
+        smallest = min(v['bytes'] for v in variants)
+        print('{:<26} {:>8} bytes -> {} variants, {}-{} bytes'.format(
+            name, original, len(variants), smallest, max(v['bytes'] for v in variants)))
+
+    keep = {variant['file'] for variants in manifest.values() for variant in variants}
+    for filename in os.listdir(BUILD_DIR):
+        if filename != 'manifest.json' and filename not in keep:
+            os.remove(os.path.join(BUILD_DIR, filename))
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_manifest = load_manifest()
+
+
+def picture(name, style=None, **kwargs):
+    """An html.Picture of the built variants of assets/<name>, or a plain html.Img if there are none."""
+    variants = _manifest.get(name)
+    if not variants:
+        return html.Img(src=dash.get_asset_url(name), style=style, **kwargs)
+    sizes = IMAGES[name]['sizes']
+    by_type = {}
+    for variant in variants:
+        by_type.setdefault(variant['type'], []).append(variant)
+
+    def srcset(items):
+        return ', '.join('{}{} {}w'.format(URL_PREFIX, v['file'], v['width']) for v in items)
+
+    sources = [html.Source(srcSet=srcset(items), type=mimetype, sizes=sizes)
+               for mimetype, items in by_type.items() if mimetype != 'image/png']
+    fallback = by_type['image/png']
+    img = html.Img(src=URL_PREFIX + fallback[-1]['file'], srcSet=srcset(fallback), sizes=sizes, style=style, **kwargs)
+    return html.Picture(sources + [img])
+
+
+def install(server):
+    """Serve assets_build/ from URL_PREFIX with immutable caching."""
+    def optimized_asset(filename):
+        response = flask.send_from_directory(BUILD_DIR, filename)
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
+
+    server.add_url_rule(URL_PREFIX + '<path:filename>', 'optimized_asset', optimized_asset)
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,45 @@
+# Compares padding every opening line to max_length against length-bucketed dynamic padding
+#
+#   python benchmarks/bench_padding.py [--tiny] [--lines 256] [--batch-size 16]
+
+import argparse
+import time
+
+import torch
+
+from common import make_classifier, opening_lines, tiny_config
+from inference import classify_batch
+
+
+def run(model, tokenizer, lines, batch_size, padding):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(lines), batch_size):
+        results.extend(classify_batch(lines[i:i + batch_size], model, tokenizer, torch.device('cpu'), padding=padding))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiny', action='store_true', help='use a 2 layer model instead of the bert-base shape')
+    parser.add_argument('--lines', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args()
+
+    model, tokenizer, words = make_classifier(tiny_config() if args.tiny else None)
+    lines = opening_lines(words, args.lines)
+    run(model, tokenizer, lines[:args.batch_size], args.batch_size, 'longest')  # warm up
+
+    fixed_time, fixed = run(model, tokenizer, lines, args.batch_size, 'max_length')
+    dynamic_time, dynamic = run(model, tokenizer, lines, args.batch_size, 'longest')
+    agreement = sum(a[0] == b[0] for a, b in zip(fixed, dynamic)) / len(lines)
+    max_prob_diff = max(abs(a[1] - b[1]) for a, b in zip(fixed, dynamic))
+
+    print('{} lines, batch size {}'.format(len(lines), args.batch_size))
+    print('max_length padding: {:8.1f} lines/s'.format(len(lines) / fixed_time))
+    print('dynamic padding:    {:8.1f} lines/s  ({:.1f}x)'.format(len(lines) / dynamic_time, fixed_time / dynamic_time))
+    print('prediction agreement {:.2%}, max probability difference {:.2e}'.format(agreement, max_prob_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Checks that the rate charts render for every metric, dimension and chart mode, unfiltered and under
+# crossfilter selections, including selections no row matches (no X gender, and no women in the real
+# table give their sexuality as Straight Male)
+#
+#   python benchmarks/check_charts.py [--rows 100000]
+#
+# Runs against Data/descriptive_stats, or a synthetic table of --rows users. A selection matching nothing
+# must give the empty "no rows match" figure rather than an error. The exit code is non-zero if any
+# chart fails.
+
+import argparse
+import sys
+
+from common import synthetic_users
+from aggregates import DIMENSIONS, AggregateCube
+from crossfilter import CrossfilterIndex
+from figures import FigureCache, RATE_CHARTS
+from snapshot import load_table
+import sketches
+
+SELECTIONS = {
+    'none': None,
+    'female': (('gender', ('F',)),),
+    'unknown_gender': (('gender', ('X',)),),
+    'female_straight_male': (('gender', ('F',)), ('sexuality', ('Straight Male',))),
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, help='use a synthetic table of this many users')
+    args = parser.parse_args()
+
+    df = synthetic_users(args.rows) if args.rows else load_table('descriptive_stats')
+    cube, index, cache = AggregateCube(df), CrossfilterIndex(df), FigureCache()
+    failures = []
+    for name, filters in SELECTIONS.items():
+        empty = filters is not None and len(index.select(filters)) == 0
+        for metric in RATE_CHARTS:
+            for dimension in DIMENSIONS:
+                for mode in sketches.MODES:
+                    try:
+                        if filters is None:
+                            figure = cache.figure(cube, metric, dimension, mode=mode)
+                        else:
+                            figure = cache.figure(index, metric, dimension, filters, mode)
+                    except Exception as e:
+                        failures.append((name, metric, dimension, mode, repr(e)))
+                        continue
+                    if empty and figure['data'] and any(trace.get('x') is not None and len(trace['x']) for trace in figure['data']):
+                        failures.append((name, metric, dimension, mode, 'drew data for an empty selection'))
+    checked = len(SELECTIONS) * len(RATE_CHARTS) * len(DIMENSIONS) * len(sketches.MODES)
+    print('{} charts checked on {} rows, {} failures'.format(checked, len(df), len(failures)))
+    for failure in failures[:20]:
+        print('  {}: {} by {} ({}): {}'.format(*failure))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
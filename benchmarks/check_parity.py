@@ -0,0 +1,86 @@
+# Checks that the int8, compiled and early_exit inference modes agree with the fp32 classifier
+#
+#   python benchmarks/check_parity.py --texts held_out.csv [--label-column label]
+#   python benchmarks/check_parity.py --synthetic
+#
+# --texts is a CSV of held-out opening lines (a `text` column by default). When it also has labels,
+# accuracy is reported for every mode, and a mode fails if it is less accurate than fp32 by more than
+# --max-accuracy-drop. A mode also fails when it agrees with fp32 on fewer than --min-agreement of the
+# texts. The exit code is non-zero if any mode fails. early_exit is only checked when asked for with
+# --modes, since it needs heads calibrated for the checkpoint (see early_exit.py), and also reports the
+# average layers it ran.
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+import torch
+
+from common import make_classifier, opening_lines
+from inference import INFERENCE_MODES, classify_batch, load_classifier, prepare_model
+
+
+def score(model, tokenizer, texts, batch_size):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(texts), batch_size):
+        results.extend(classify_batch(texts[i:i + batch_size], model, tokenizer, torch.device('cpu')))
+    return [pred for pred, _ in results], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts', help='CSV of held-out opening lines')
+    parser.add_argument('--text-column', default='text')
+    parser.add_argument('--label-column')
+    parser.add_argument('--checkpoint', default='bert_classifier.pth')
+    parser.add_argument('--synthetic', action='store_true', help='random bert-base shaped model and synthetic lines, no network needed')
+    parser.add_argument('--modes', nargs='+', default=[mode for mode in INFERENCE_MODES if mode not in ('fp32', 'early_exit')])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--min-agreement', type=float, default=0.99)
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.0)
+    args = parser.parse_args()
+
+    labels = None
+    if args.synthetic:
+        model, tokenizer, words = make_classifier()
+        texts = opening_lines(words, 512)
+    elif args.texts:
+        from transformers import BertTokenizer
+        held_out = pd.read_csv(args.texts)
+        texts = held_out[args.text_column].astype(str).tolist()
+        if args.label_column:
+            labels = held_out[args.label_column].astype(int).tolist()
+        model = load_classifier(args.checkpoint)
+        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    else:
+        parser.error('pass --texts or --synthetic')
+
+    reference, reference_time = score(model, tokenizer, texts, args.batch_size)
+    accuracy = None
+    if labels is not None:
+        accuracy = sum(p == l for p, l in zip(reference, labels)) / len(labels)
+    print('{:<9} {:8.1f} texts/s{}'.format('fp32', len(texts) / reference_time,
+                                           '' if accuracy is None else '  accuracy {:.2%}'.format(accuracy)))
+
+    failed = False
+    for mode in args.modes:
+        prepared = prepare_model(model, mode)
+        preds, elapsed = score(prepared, tokenizer, texts, args.batch_size)
+        agreement = sum(a == b for a, b in zip(preds, reference)) / len(texts)
+        line = '{:<9} {:8.1f} texts/s  agreement {:.2%}'.format(mode, len(texts) / elapsed, agreement)
+        if hasattr(prepared, 'average_layers'):
+            line += '  average layers {:.2f}'.format(prepared.average_layers())
+        ok = agreement >= args.min_agreement
+        if labels is not None:
+            mode_accuracy = sum(p == l for p, l in zip(preds, labels)) / len(labels)
+            line += '  accuracy {:.2%}'.format(mode_accuracy)
+            ok = ok and accuracy - mode_accuracy <= args.max_accuracy_drop
+        print(line + ('' if ok else '  FAILED'))
+        failed = failed or not ok
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Checks that the inference tokenizer (BertTokenizerFast behind a CachedTokenizer) produces exactly the
+# ids of the BertTokenizer the classifier was trained with
+#
+#   python benchmarks/check_tokenizer.py [--texts held_out.csv] [--vocab vocab.txt]
+#
+# Every vocab entry is encoded on its own, and again as a growing typed-out sentence so the cache's
+# prefix path is exercised; --texts adds held-out opening lines. Without --vocab the bert-base-uncased
+# vocab is downloaded. Also prints single-text and batched tokenization throughput of both tokenizers.
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+from transformers import BertTokenizer, BertTokenizerFast
+
+import common  # noqa: F401 (puts the repository root on sys.path)
+from inference import CachedTokenizer
+
+SAMPLES = [
+    'Test your best opening line....',
+    'Hey! How was your weekend?? 😊',
+    'Ça va? Je m\'appelle Zoë',
+    "what's   up\twith\nyou",
+    'I bet you can\'t guess my favourite 🍕 topping',
+    '',
+]
+
+
+def typed_out(words):
+    text = ''
+    for word in words:
+        text = (text + ' ' + word).strip()
+        yield text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts', help='CSV of opening lines to compare as well')
+    parser.add_argument('--text-column', default='text')
+    parser.add_argument('--vocab', help='vocab.txt to build both tokenizers from')
+    parser.add_argument('--max-length', type=int, default=128)
+    args = parser.parse_args()
+
+    if args.vocab:
+        slow, fast = BertTokenizer(args.vocab), BertTokenizerFast(args.vocab)
+    else:
+        slow, fast = BertTokenizer.from_pretrained('bert-base-uncased'), BertTokenizerFast.from_pretrained('bert-base-uncased')
+    cached = CachedTokenizer(fast)
+
+    vocab = list(slow.vocab)
+    texts = list(SAMPLES) + [token.replace('##', '') for token in vocab]
+    for i in range(0, len(vocab), 40):
+        texts.extend(typed_out(vocab[i:i + 40]))
+    if args.texts:
+        texts.extend(pd.read_csv(args.texts)[args.text_column].astype(str))
+
+    expected = slow(texts, max_length=args.max_length, truncation=True)['input_ids']
+    mismatches = []
+    for name, tokenizer in [('fast', fast), ('cached', cached)]:
+        for i in range(0, len(texts), 256):
+            got = tokenizer(texts[i:i + 256], max_length=args.max_length, truncation=True)['input_ids']
+            mismatches.extend((name, text) for text, a, b in zip(texts[i:i + 256], got, expected[i:i + 256]) if a != b)
+    print('{} texts compared, {} mismatches'.format(len(texts), len(mismatches)))
+    for name, text in mismatches[:20]:
+        print('  {}: {!r}'.format(name, text))
+
+    sample = texts[:2000]
+    for name, tokenizer in [('slow', slow), ('fast', fast), ('cached', CachedTokenizer(fast))]:
+        start = time.perf_counter()
+        for text in sample:
+            tokenizer([text], max_length=args.max_length, truncation=True)
+        single = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(0, len(sample), 32):
+            tokenizer(sample[i:i + 32], max_length=args.max_length, truncation=True)
+        batched = time.perf_counter() - start
+        print('{:<7} {:9.0f} texts/s one at a time  {:9.0f} texts/s in batches of 32'.format(
+            name, len(sample) / single, len(sample) / batched))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
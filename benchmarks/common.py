@@ -0,0 +1,86 @@
+# Offline stand-ins for bert-base-uncased and the user table, so benchmarks run without network access
+
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import BertConfig, BertModel, BertTokenizer
+
+# benchmarks are run from the repository root, as the app is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from inference import BERTClassifier  # noqa: E402
+
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def make_vocab(directory, size=2000):
+    words = ['w{}'.format(i) for i in range(size - len(SPECIAL_TOKENS))]
+    path = os.path.join(directory, 'vocab.txt')
+    with open(path, 'w') as f:
+        f.write('\n'.join(SPECIAL_TOKENS + words) + '\n')
+    return path, words
+
+
+def make_model_dir(config=None, seed=0):
+    """A directory usable as bert_model_name: random weights, a vocab, and a classifier.pth checkpoint.
+
+    The default config has the shape of bert-base-uncased.
+    """
+    directory = tempfile.mkdtemp(prefix='bench-bert-')
+    _, words = make_vocab(directory)
+    config = config or BertConfig()
+    config.vocab_size = len(SPECIAL_TOKENS) + len(words)
+    torch.manual_seed(seed)
+    BertModel(config).save_pretrained(directory)
+    model = BERTClassifier(directory, 2)
+    torch.save(model.state_dict(), os.path.join(directory, 'classifier.pth'))
+    return directory, words
+
+
+def make_classifier(config=None, seed=0):
+    """A randomly initialized BERTClassifier and a tokenizer whose words are single tokens."""
+    directory, words = make_model_dir(config, seed)
+    model = BERTClassifier(directory, 2)
+    model.load_state_dict(torch.load(os.path.join(directory, 'classifier.pth')))
+    model.eval()
+    return model, BertTokenizer(os.path.join(directory, 'vocab.txt')), words
+
+
+def tiny_config():
+    return BertConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=2, intermediate_size=128)
+
+
+def opening_lines(words, count, seed=0, min_words=2, max_words=30):
+    """Texts with realistic opening-line lengths, skewed towards a handful of words."""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        length = min(max_words, max(min_words, int(rng.expovariate(1 / 8))))
+        lines.append(' '.join(rng.choice(words) for _ in range(length)))
+    return lines
+
+
+def synthetic_users(rows, seed=0):
+    """A descriptive_stats shaped frame of the given size, with the value mix of the real table."""
+    from snapshot import SCHEMAS, load_table
+    real = load_table('descriptive_stats')
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for column, dtype in SCHEMAS['descriptive_stats'].items():
+        if dtype == 'float32':
+            values = real[column].dropna().to_numpy()
+            sampled = rng.choice(values, rows)
+            sampled[rng.random(rows) < real[column].isna().mean()] = np.nan
+            columns[column] = sampled.astype('float32')
+        else:
+            counts = real[column].value_counts(normalize=True, dropna=False)
+            codes = rng.choice(len(counts), rows, p=counts.to_numpy())
+            values = pd.Series(counts.index.to_numpy(dtype=object)).take(codes).reset_index(drop=True)
+            columns[column] = values.astype(dtype)
+    return pd.DataFrame(columns)
@@ -0,0 +1,45 @@
+# Compares two result files written by benchmarks/run.py
+#
+#   python benchmarks/compare.py old.json new.json [--threshold 0.2]
+#
+# Prints every measurement present in both, with the relative change. Seconds are better lower and
+# texts/s better higher; changes worse than --threshold are flagged and make the exit code non-zero.
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data['meta'], {record['name']: record for record in data['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    old_meta, old = load(args.old)
+    new_meta, new = load(args.new)
+    print('{} -> {}'.format(old_meta.get('commit'), new_meta.get('commit')))
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]['value'], new[name]['value']
+        if not before:
+            continue
+        change = after / before - 1
+        worse = -change if new[name]['unit'].endswith('/s') else change
+        flag = ''
+        if worse > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<58} {:>12.4f} -> {:>12.4f} {:<7} {:+7.1%}{}'.format(name, before, after, new[name]['unit'], change, flag))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# Offline benchmark suite: startup, chart callbacks and inference
+#
+#   python benchmarks/run.py [--quick] [--output results.json]
+#   python benchmarks/compare.py old.json new.json
+#
+# Startup imports app.py and Data/blahsdffjsf.py in fresh processes, the latter against a tiny randomly
+# initialized BERT so nothing is downloaded. Chart callbacks, and filtered charts through crossfilter.py,
+# run on synthetic descriptive_stats shaped tables of 1k/100k/10M rows (--quick stops at 100k), as do exact
+# groupby percentiles against the distribution sketches of sketches.py. Inference times classify_batch and the batching engine on the tiny model at several batch sizes, and the engine
+# backed by 1, 2 and cpu_count() worker processes (inference_pool.py). Results are written as JSON, one
+# record per measurement.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+from common import ROOT, make_model_dir, opening_lines, synthetic_users, tiny_config
+
+from aggregates import DIMENSIONS, AggregateCube  # noqa: E402
+from crossfilter import CrossfilterIndex  # noqa: E402
+from figures import build_rate_figure  # noqa: E402
+import sketches  # noqa: E402
+
+CHART_METRICS = {'match': 'AverageMatchRate', 'swipe': 'AveragePercentageSwipeRight'}
+
+# filtered charts: a selective and a broad selection, grouped by age
+CROSSFILTERS = {
+    'female_with_job': (('gender', ('F',)), ('ProfileShowsJob', (True,))),
+    'male': (('gender', ('M',)),),
+}
+
+STARTUP_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+{import_line}
+imported = time.perf_counter()
+loader = getattr(module, 'classifier', None)
+while loader is not None and loader.state == 'loading':
+    time.sleep(0.01)
+ready = time.perf_counter()
+print(imported - started, ready - started, loader.state if loader is not None else 'none')
+'''
+
+
+class Results:
+    def __init__(self):
+        self.records = []
+
+    def add(self, name, value, unit, **params):
+        self.records.append(dict(name=name, value=value, unit=unit, **params))
+        print('{:<58} {:>12.4f} {}'.format(name, value, unit))
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_startup(results, model_dir, repeat):
+    env = dict(os.environ, BERT_MODEL_NAME=model_dir, BERT_CHECKPOINT=os.path.join(model_dir, 'classifier.pth'),
+               HF_HUB_OFFLINE='1', TRANSFORMERS_OFFLINE='1', PREDICTION_STORE='')
+    targets = {
+        'app.py': 'import app as module',
+        'Data/blahsdffjsf.py': 'import Data.blahsdffjsf as module',
+    }
+    for target, import_line in targets.items():
+        imports, readies = [], []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(import_line=import_line)], cwd=ROOT, env=env,
+                                 check=True, capture_output=True, text=True).stdout.split('\n')[-2].split()
+            imports.append(float(out[0]))
+            readies.append(float(out[1]))
+        results.add('startup.import.{}'.format(target), statistics.median(imports), 's', target=target)
+        if out[2] != 'none':
+            results.add('startup.model_ready.{}'.format(target), statistics.median(readies), 's', target=target, state=out[2])
+
+
+def bench_charts(results, rows, repeat):
+    import app
+
+    df = synthetic_users(rows)
+    start = time.perf_counter()
+    cube = AggregateCube(df)
+    results.add('charts.cube_build.rows={}'.format(rows), time.perf_counter() - start, 's', rows=rows)
+
+    app.aggregate_cube = cube
+    callbacks = {'match': app.update_match_chart, 'swipe': app.update_swipe_chart}
+    for chart, metric in CHART_METRICS.items():
+        for dimension in DIMENSIONS:
+            params = dict(rows=rows, chart=chart, dimension=dimension)
+            groupby = timed(lambda: df.groupby(dimension, observed=True)[metric].mean(), repeat)
+            results.add('charts.groupby.{}.{}.rows={}'.format(chart, dimension, rows), statistics.median(groupby), 's', **params)
+            rebuild = timed(lambda: build_rate_figure(cube.mean(dimension, metric), metric).to_json(), repeat)
+            results.add('charts.rebuild.{}.{}.rows={}'.format(chart, dimension, rows), statistics.median(rebuild), 's', **params)
+            app.figure_cache.clear()
+            cold = timed(lambda: callbacks[chart](dimension), 1)
+            results.add('charts.callback_cold.{}.{}.rows={}'.format(chart, dimension, rows), cold[0], 's', **params)
+            warm = timed(lambda: callbacks[chart](dimension), repeat)
+            results.add('charts.callback_warm.{}.{}.rows={}'.format(chart, dimension, rows), statistics.median(warm), 's', **params)
+
+    start = time.perf_counter()
+    index = CrossfilterIndex(df)
+    results.add('charts.crossfilter_build.rows={}'.format(rows), time.perf_counter() - start, 's', rows=rows)
+    for name, filters in CROSSFILTERS.items():
+        params = dict(rows=rows, filters=name, selected=len(index.select(filters)))
+
+        def masked():
+            mask = True
+            for dimension, values in filters:
+                mask = mask & df[dimension].isin(values)
+            return df[mask].groupby('AgeofUserGroup', observed=True)['AverageMatchRate'].mean()
+
+        results.add('charts.filter_mask.{}.rows={}'.format(name, rows), statistics.median(timed(masked, repeat)), 's', **params)
+        indexed = timed(lambda: index.mean('AgeofUserGroup', 'AverageMatchRate', filters), repeat)
+        results.add('charts.filter_index.{}.rows={}'.format(name, rows), statistics.median(indexed), 's', **params)
+
+    # exact per-group percentiles against reading them off the cube's sketches
+    for dimension in DIMENSIONS:
+        params = dict(rows=rows, dimension=dimension)
+        exact = timed(lambda: df.groupby(dimension, observed=True)['AverageMatchRate'].quantile(list(sketches.PERCENTILES)), repeat)
+        results.add('charts.distribution.groupby_quantile.{}.rows={}'.format(dimension, rows), statistics.median(exact), 's', **params)
+        sketched = timed(lambda: sketches.quantile_table(*cube.bucket_counts(dimension, 'AverageMatchRate'), sketches.PERCENTILES, dimension), repeat)
+        results.add('charts.distribution.sketch_quantile.{}.rows={}'.format(dimension, rows), statistics.median(sketched), 's', **params)
+        edges = np.linspace(0, 1, sketches.HISTOGRAM_BINS + 1)
+        histogram = timed(lambda: sketches.histogram_table(*cube.bucket_counts(dimension, 'AverageMatchRate'), edges, dimension), repeat)
+        results.add('charts.distribution.sketch_histogram.{}.rows={}'.format(dimension, rows), statistics.median(histogram), 's', **params)
+
+
+def bench_inference(results, model_dir, batch_sizes, repeat):
+    from transformers import BertTokenizerFast
+
+    from inference import CachedTokenizer, InferenceEngine, classify_batch, load_classifier
+    from inference_pool import InferencePool
+
+    model = load_classifier(os.path.join(model_dir, 'classifier.pth'), model_dir)
+    tokenizer = BertTokenizerFast.from_pretrained(model_dir)
+    words = [w for w in tokenizer.vocab if w.startswith('w')]
+    lines = opening_lines(words, max(batch_sizes) * repeat, seed=1)
+    device = torch.device('cpu')
+    classify_batch(lines[:8], model, tokenizer, device)  # warm up
+
+    single = timed(lambda: classify_batch([lines[0]], model, tokenizer, device), repeat * 4)
+    results.add('inference.predict_latency_p50', statistics.median(single), 's')
+    results.add('inference.predict_latency_p99', sorted(single)[int(len(single) * 0.99) - 1], 's')
+    for batch_size in batch_sizes:
+        samples = timed(lambda: classify_batch(lines[:batch_size], model, tokenizer, device), repeat)
+        results.add('inference.batch_latency.batch={}'.format(batch_size), statistics.median(samples), 's', batch_size=batch_size)
+        results.add('inference.throughput.batch={}'.format(batch_size), batch_size / statistics.median(samples), 'texts/s', batch_size=batch_size)
+
+    cached = CachedTokenizer(tokenizer)
+    tokenize = timed(lambda: tokenizer(lines, max_length=128, truncation=True), repeat)
+    results.add('inference.tokenize.fast', len(lines) / statistics.median(tokenize), 'texts/s')
+    cached(lines, max_length=128, truncation=True)
+    tokenize = timed(lambda: cached(lines, max_length=128, truncation=True), repeat)
+    results.add('inference.tokenize.cached', len(lines) / statistics.median(tokenize), 'texts/s')
+
+    for threads in (1, 8, 32):
+        engine = InferenceEngine(model, tokenizer, device, max_batch_size=max(batch_sizes), max_wait_ms=5)
+        throughput = engine_throughput(engine, lines, threads)
+        engine.stop()
+        results.add('inference.engine_throughput.clients={}'.format(threads), throughput, 'texts/s', clients=threads)
+
+    cores = os.cpu_count() or 1
+    for processes in sorted({1, 2, cores}):
+        pool = InferencePool(model, tokenizer, device, processes, threads=max(1, cores // processes),
+                             max_batch_size=max(batch_sizes), max_wait_ms=5)
+        # workers load the model on first use
+        engine_throughput(pool, lines[:processes * 8], processes * 8)
+        throughput = engine_throughput(pool, lines, 32)
+        pool.stop()
+        results.add('inference.pool_throughput.processes={}'.format(processes), throughput, 'texts/s', processes=processes)
+
+
+def engine_throughput(engine, lines, threads):
+    """Texts per second classified through engine by `threads` concurrent clients."""
+    per_thread = max(4, len(lines) // threads)
+
+    def client(offset):
+        for text in lines[offset:offset + per_thread]:
+            engine.predict(text)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=client, args=(i * per_thread % len(lines),)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * per_thread / (time.perf_counter() - start)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true', help='skip the 10M row tables')
+    parser.add_argument('--sizes', type=int, nargs='+')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=['startup', 'charts', 'inference'], default=['startup', 'charts', 'inference'])
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+    sizes = args.sizes or ([1000, 100000] if args.quick else [1000, 100000, 10000000])
+
+    os.chdir(ROOT)
+    model_dir, _ = make_model_dir(tiny_config())
+    results = Results()
+    if 'startup' in args.only:
+        bench_startup(results, model_dir, repeat=3 if args.quick else args.repeat)
+    if 'charts' in args.only:
+        for rows in sizes:
+            bench_charts(results, rows, args.repeat)
+    if 'inference' in args.only:
+        bench_inference(results, model_dir, args.batch_sizes, args.repeat)
+
+    meta = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results.records}, f, indent=1)
+    print('wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
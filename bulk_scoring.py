@@ -0,0 +1,95 @@
+# Bulk scoring of opening lines over HTTP, streamed back as newline-delimited JSON
+#
+#   curl -H 'Content-Type: application/json' -d '{"texts": ["hey", "nice dog!"]}' https://.../score
+#   {"index": 0, "label": 0, "probability": 0.61}
+#   {"index": 1, "label": 1, "probability": 0.83}
+#
+# Texts are classified in batches of BULK_BATCH_SIZE by the InferenceEngine the dashboard already has loaded,
+# and each result line is sent as soon as its batch is done. Bulk work gives way to the interactive
+# opening line rater: batches are queued on the engine behind every interactive request already waiting,
+# and run on its thread (or one of its workers, with inference_pool.py) like any other batch, so the two
+# never run side by side on the same cores. Batches are small so an interactive request arriving mid-job
+# waits behind at most one, and each process runs at most BULK_MAX_JOBS jobs, answering 429 beyond that.
+# The next batch isn't scored until the client has taken the previous results, so a slow reader holds
+# back its own job rather than buffering results in memory.
+# Requests are limited to MAX_BODY_BYTES, MAX_TEXTS texts and MAX_TEXT_CHARS characters per text.
+# With SCORING_TOKEN set, requests need an Authorization: Bearer <token> header.
+
+import json
+import os
+import threading
+
+import flask
+
+from model_loader import ModelNotReady
+
+BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 16))
+MAX_JOBS = int(os.environ.get('BULK_MAX_JOBS', 1))
+MAX_TEXTS = int(os.environ.get('BULK_MAX_TEXTS', 10000))
+MAX_TEXT_CHARS = 2000
+MAX_BODY_BYTES = 4 * 1024 * 1024
+SCORING_TOKEN = os.environ.get('SCORING_TOKEN', '')
+
+
+def _error(message, status, **headers):
+    response = flask.jsonify({'error': message})
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+
+def parse_texts(body):
+    """The list of texts in a request body, or raise ValueError saying what is wrong with it."""
+    payload = json.loads(body)
+    texts = payload.get('texts') if isinstance(payload, dict) else payload
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise ValueError('expected {"texts": [...]} or a JSON list of strings')
+    if len(texts) > MAX_TEXTS:
+        raise ValueError('at most {} texts per request'.format(MAX_TEXTS))
+    too_long = next((i for i, text in enumerate(texts) if len(text) > MAX_TEXT_CHARS), None)
+    if too_long is not None:
+        raise ValueError('text {} is longer than {} characters'.format(too_long, MAX_TEXT_CHARS))
+    return texts
+
+
+def score(texts, engine, batch_size=BATCH_SIZE):
+    """NDJSON lines of (index, label, probability), a batch at a time."""
+    for start in range(0, len(texts), batch_size):
+        try:
+            results = engine.classify(texts[start:start + batch_size])
+        except Exception as e:
+            yield json.dumps({'error': repr(e), 'index': start}) + '\n'
+            return
+        yield ''.join(json.dumps({'index': start + i, 'label': label, 'probability': probability}) + '\n'
+                      for i, (label, probability) in enumerate(results))
+
+
+def install(server, loader):
+    """Serve POST /score with the InferenceEngine that loader (a ModelLoader) provides."""
+    jobs = threading.BoundedSemaphore(MAX_JOBS)
+
+    def score_texts():
+        request = flask.request
+        if SCORING_TOKEN and request.headers.get('Authorization', '') != 'Bearer ' + SCORING_TOKEN:
+            return _error('unauthorized', 401)
+        # read one byte past the limit, so a body without Content-Length can't be any bigger either
+        body = request.stream.read(MAX_BODY_BYTES + 1)
+        if len(body) > MAX_BODY_BYTES:
+            return _error('body larger than {} bytes'.format(MAX_BODY_BYTES), 413)
+        try:
+            texts = parse_texts(body)
+        except ValueError as e:
+            return _error(str(e), 400)
+        try:
+            engine = loader.get()
+        except ModelNotReady:
+            return _error('the model is still loading', 503, **{'Retry-After': '30'})
+        if not jobs.acquire(blocking=False):
+            return _error('too many bulk jobs running, try again shortly', 429, **{'Retry-After': '5'})
+        response = flask.Response(score(texts, engine), mimetype='application/x-ndjson')
+        # released when the response is closed, whether it was streamed to the end or the client went away
+        response.call_on_close(jobs.release)
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    server.add_url_rule('/score', 'score_texts', score_texts, methods=['POST'])
@@ -0,0 +1,293 @@
+# Out-of-core aggregation of the swipe/match metrics, for user tables too big to load into memory
+#
+# build_cube(path) streams a CSV, or an Arrow snapshot written by snapshot.py, reading only the dimension
+# and metric columns. Each chunk's dimension columns are dictionary encoded (pandas categoricals) and
+# reduced with np.bincount to per-group float64 sums and non-null counts. Partial aggregates are merged
+# by group label, so memory stays at one chunk per process plus one row per group, whatever the size of
+# the input. With workers > 1 the input is split into ranges (record batches of a snapshot, or byte
+# ranges of a CSV that end on a newline outside quotes) aggregated in parallel processes.
+#
+# The cube has the same groups, counts and means as AggregateCube(df) on the whole table. Sums are
+# float64 over float32 rates, so means agree with df.groupby(dimension)[metric].mean() to ~1e-12
+# relative, whatever the chunking. The distribution sketches of sketches.py are built alongside, and
+# being counts, merge exactly.
+#
+# Set AGGREGATES_SOURCE to a path to build the dashboard's chart aggregates this way.
+#
+#   python chunked_aggregates.py PATH [--workers N] [--chunk-rows N] [--compare]
+#
+# --compare also loads the whole table and checks every group, count and mean against groupby(), exiting
+# non-zero if any differ or a mean is off by more than COMPARE_TOLERANCE relative.
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import sketches
+from aggregates import DIMENSIONS, METRICS, AggregateCube
+from snapshot import SCHEMAS
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+SOURCE = os.environ.get('AGGREGATES_SOURCE', '')
+WORKERS = int(os.environ.get('AGGREGATES_WORKERS', 1))
+CHUNK_ROWS = 1000000
+COMPARE_TOLERANCE = 1e-12
+
+BLOCK = 1 << 20
+
+
+class Partial:
+    """Sums and counts of each metric for every group of every dimension, over some of the rows."""
+
+    def __init__(self, dimensions=DIMENSIONS, metrics=METRICS):
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        self.rows = 0
+        self.codes = {dimension: {} for dimension in self.dimensions}
+        self.sums = {dimension: np.zeros((0, len(self.metrics))) for dimension in self.dimensions}
+        self.counts = {dimension: np.zeros((0, len(self.metrics)), dtype='int64') for dimension in self.dimensions}
+        self.buckets = {dimension: np.zeros((0, len(self.metrics), sketches.BUCKETS), dtype='int64') for dimension in self.dimensions}
+
+    def _encode(self, dimension, labels):
+        """Codes of labels in this partial's dictionary for dimension, adding the new ones."""
+        codes = self.codes[dimension]
+        mapped = np.array([codes.setdefault(label, len(codes)) for label in labels], dtype='int64')
+        grow = len(codes) - len(self.sums[dimension])
+        if grow:
+            self.sums[dimension] = np.vstack([self.sums[dimension], np.zeros((grow, len(self.metrics)))])
+            self.counts[dimension] = np.vstack([self.counts[dimension], np.zeros((grow, len(self.metrics)), dtype='int64')])
+            self.buckets[dimension] = np.concatenate([self.buckets[dimension],
+                                                      np.zeros((grow, len(self.metrics), sketches.BUCKETS), dtype='int64')])
+        return mapped
+
+    def add_chunk(self, chunk):
+        self.rows += len(chunk)
+        values = [chunk[metric].to_numpy(dtype='float64', na_value=np.nan) for metric in self.metrics]
+        for dimension in self.dimensions:
+            column = chunk[dimension]
+            if not isinstance(column.dtype, pd.CategoricalDtype):
+                column = column.astype('category')
+            local = column.cat.codes.to_numpy()
+            grouped = local >= 0  # -1 is a missing label, which groupby drops
+            # only labels present in the chunk become groups, as with groupby(observed=True)
+            present = np.flatnonzero(np.bincount(local[grouped], minlength=len(column.cat.categories)))
+            mapping = np.zeros(len(column.cat.categories), dtype='int64')
+            mapping[present] = self._encode(dimension, [_plain(column.cat.categories[i]) for i in present])
+            groups = mapping[local[grouped]]
+            size = len(self.codes[dimension])
+            for j, metric_values in enumerate(values):
+                metric_values = metric_values[grouped]
+                valid = ~np.isnan(metric_values)
+                self.sums[dimension][:, j] += np.bincount(groups[valid], weights=metric_values[valid], minlength=size)
+                self.counts[dimension][:, j] += np.bincount(groups[valid], minlength=size)
+                self.buckets[dimension][:, j] += sketches.bucket_counts(groups, metric_values, size)
+
+    def merge(self, other):
+        self.rows += other.rows
+        for dimension in self.dimensions:
+            labels = list(other.codes[dimension])
+            mapped = self._encode(dimension, labels)
+            order = [other.codes[dimension][label] for label in labels]
+            self.sums[dimension][mapped] += other.sums[dimension][order]
+            self.counts[dimension][mapped] += other.counts[dimension][order]
+            self.buckets[dimension][mapped] += other.buckets[dimension][order]
+        return self
+
+    def tables(self):
+        """Sum/count tables in the layout of AggregateCube.tables, groups sorted as groupby sorts them."""
+        tables = {}
+        for dimension in self.dimensions:
+            labels = sorted(self.codes[dimension])
+            rows = [self.codes[dimension][label] for label in labels]
+            columns = {}
+            for j, metric in enumerate(self.metrics):
+                columns[(metric, 'sum')] = self.sums[dimension][rows, j]
+                columns[(metric, 'count')] = self.counts[dimension][rows, j]
+            table = pd.DataFrame(columns, index=pd.Index(labels, name=dimension))
+            table.columns = pd.MultiIndex.from_tuples(table.columns)
+            tables[dimension] = table
+        return tables
+
+    def distributions(self):
+        return sketches.DistributionCube.from_counts({dimension: list(codes) for dimension, codes in self.codes.items()},
+                                                     self.buckets, self.metrics)
+
+    def cube(self):
+        return AggregateCube.from_tables(self.tables(), self.rows, self.metrics, self.distributions())
+
+
+def _plain(label):
+    return label.item() if hasattr(label, 'item') else label
+
+
+def _dtypes(dimensions, metrics):
+    schema = SCHEMAS['descriptive_stats']
+    dtypes = {dimension: 'boolean' if schema.get(dimension) == 'bool' else 'category' for dimension in dimensions}
+    dtypes.update({metric: 'float64' for metric in metrics})
+    return dtypes
+
+
+def _is_arrow(path):
+    return path.endswith(('.arrow', '.feather'))
+
+
+class _ByteRange(io.RawIOBase):
+    """The bytes of an open file from its current position up to end."""
+
+    def __init__(self, f, end):
+        self.f = f
+        self.remaining = end - f.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def csv_ranges(path, parts):
+    """(header, [(start, end), ...]) splitting the rows of a CSV into about `parts` byte ranges.
+
+    Ranges end on a newline outside quoted fields, found by tracking quote parity from the start of the file.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        start = f.tell()
+        boundaries = [start]
+        quoted = False
+        for i in range(1, parts):
+            target = start + (size - start) * i // parts
+            if target <= f.tell():
+                continue
+            while f.tell() < target:
+                quoted ^= f.read(min(BLOCK, target - f.tell())).count(b'"') % 2 == 1
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    break
+                if byte == b'"':
+                    quoted = not quoted
+                elif byte == b'\n' and not quoted:
+                    break
+            if f.tell() < size:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+    return header, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def aggregate_csv_range(path, header, start, end, dimensions=DIMENSIONS, metrics=METRICS, chunk_rows=CHUNK_ROWS):
+    partial = Partial(dimensions, metrics)
+    columns = list(dimensions) + list(metrics)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        reader = pd.read_csv(io.BufferedReader(_ByteRange(f, end), BLOCK), header=None, names=header,
+                             usecols=columns, dtype=_dtypes(dimensions, metrics), chunksize=chunk_rows)
+        for chunk in reader:
+            partial.add_chunk(chunk)
+    return partial
+
+
+def aggregate_arrow_batches(path, first, last, dimensions=DIMENSIONS, metrics=METRICS):
+    partial = Partial(dimensions, metrics)
+    columns = list(dimensions) + list(metrics)
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(first, last):
+            batch = reader.get_batch(i)
+            partial.add_chunk(pa.Table.from_batches([batch]).select(columns).to_pandas())
+    return partial
+
+
+def _tasks(path, workers, dimensions, metrics, chunk_rows):
+    if _is_arrow(path):
+        with pa.memory_map(path) as source:
+            batches = pa.ipc.open_file(source).num_record_batches
+        bounds = np.linspace(0, batches, min(workers, batches) + 1).astype(int)
+        return [(aggregate_arrow_batches, (path, first, last, dimensions, metrics))
+                for first, last in zip(bounds[:-1], bounds[1:])]
+    header, ranges = csv_ranges(path, workers)
+    return [(aggregate_csv_range, (path, header, start, end, dimensions, metrics, chunk_rows)) for start, end in ranges]
+
+
+def _run(task):
+    function, args = task
+    return function(*args)
+
+
+def build_cube(path, workers=1, dimensions=DIMENSIONS, metrics=METRICS, chunk_rows=CHUNK_ROWS):
+    """An AggregateCube over the table at path, read in chunks and, with workers > 1, in parallel processes."""
+    tasks = _tasks(path, workers, dimensions, metrics, chunk_rows)
+    total = Partial(dimensions, metrics)
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+            for partial in pool.map(_run, tasks):
+                total.merge(partial)
+    else:
+        for task in tasks:
+            total.merge(_run(task))
+    return total.cube()
+
+
+def main():
+    import resource
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--compare', action='store_true', help='also load the whole table and compare with groupby().mean()')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cube = build_cube(args.path, args.workers, chunk_rows=args.chunk_rows)
+    print('{} rows in {:.2f}s, peak RSS {:.1f} MB'.format(
+        cube.rows, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    if args.compare:
+        columns = list(cube.dimensions) + list(cube.metrics)
+        if _is_arrow(args.path):
+            df = pa.ipc.open_file(pa.memory_map(args.path)).read_all().select(columns).to_pandas()
+            # snapshots hold float32 rates, which groupby would average in float32
+            df = df.astype({metric: 'float64' for metric in cube.metrics})
+        else:
+            df = pd.read_csv(args.path, usecols=columns, dtype=_dtypes(cube.dimensions, cube.metrics))
+        worst, failures = 0.0, []
+        for dimension in cube.dimensions:
+            for metric in cube.metrics:
+                grouped = df.groupby(dimension, observed=True)[metric]
+                expected, got = grouped.mean(), cube.mean(dimension, metric)
+                if list(got.index) != [_plain(label) for label in expected.index]:
+                    failures.append('{} by {}: groups differ'.format(metric, dimension))
+                    continue
+                if (cube.stats(dimension, metric)['count'].to_numpy() != grouped.count().to_numpy()).any():
+                    failures.append('{} by {}: counts differ'.format(metric, dimension))
+                got, expected = got.to_numpy(), expected.to_numpy()
+                if (np.isnan(got) != np.isnan(expected)).any():
+                    failures.append('{} by {}: groups without a mean differ'.format(metric, dimension))
+                difference = float(np.nanmax(np.abs(got / expected - 1), initial=0))
+                if difference > COMPARE_TOLERANCE:
+                    failures.append('{} by {}: relative difference {:.2e}'.format(metric, dimension, difference))
+                worst = max(worst, difference)
+        print('{} groupby().mean() comparisons, worst relative difference {:.2e} (tolerance {:.0e}), {} failures'.format(
+            len(cube.dimensions) * len(cube.metrics), worst, COMPARE_TOLERANCE, len(failures)))
+        for failure in failures:
+            print('  ' + failure)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
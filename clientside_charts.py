@@ -0,0 +1,98 @@
+# Optional mode where the swipe/match charts are drawn in the browser
+#
+# With CLIENTSIDE_CHARTS=1 the per-group means of every dimension (a few dozen numbers) are shipped once
+# in a dcc.Store, and the dropdowns redraw their chart with a clientside callback, so chart interactions
+# never reach the Python server. The figures mirror what figures.build_rate_figure draws with plotly
+# express, including its template. With ingestion on (see ingest.py), the store is re-sent whenever new
+# rows have been ingested.
+
+import json
+import math
+import os
+
+from dash import dcc
+from dash.dependencies import Input, Output
+
+from figures import RATE_CHARTS, build_rate_figure
+
+ENABLED = os.environ.get('CLIENTSIDE_CHARTS', '') == '1'
+
+STORE_ID = 'rate-aggregates'
+
+# Builds the same traces and layout as px.bar(rate_by_group, x=index, y=values, color=index, title=...)
+DRAW_RATE_FIGURE = '''
+function(dimension, store, metric) {
+    if (!dimension || !store) {
+        return window.dash_clientside.no_update;
+    }
+    const groups = store.metrics[metric][dimension];
+    const colorway = store.template.layout.colorway;
+    const data = groups.labels.map(function(label, i) {
+        return {
+            type: 'bar', orientation: 'v', textposition: 'auto', showlegend: true,
+            name: groups.names[i], legendgroup: groups.names[i],
+            hovertemplate: 'color=' + groups.names[i] + '<br>x=%{x}<br>y=%{y}<extra></extra>',
+            marker: {color: colorway[i % colorway.length], pattern: {shape: ''}},
+            x: [label], y: [groups.means[i]], xaxis: 'x', yaxis: 'y'
+        };
+    });
+    const chart = store.charts[metric];
+    return {
+        data: data,
+        layout: {
+            template: store.template,
+            xaxis: {anchor: 'y', domain: [0, 1], title: {text: 'x'}},
+            yaxis: {anchor: 'x', domain: [0, 1], title: {text: chart.yaxis_title}, tickformat: ',.0%'},
+            legend: {title: {text: 'color'}, tracegroupgap: 0},
+            title: {text: chart.title},
+            barmode: 'relative'
+        }
+    };
+}
+'''
+
+
+def store_data(cube):
+    """Group labels and means of every metric and dimension, plus what the browser needs to draw them."""
+    metrics = {}
+    for metric in RATE_CHARTS:
+        metrics[metric] = {}
+        for dimension in cube.dimensions:
+            means = cube.mean(dimension, metric)
+            labels = [label.item() if hasattr(label, 'item') else label for label in means.index]
+            metrics[metric][dimension] = {
+                'labels': labels,
+                'names': [str(label) for label in labels],
+                'means': [None if math.isnan(mean) else float(mean) for mean in means.values],
+            }
+    any_metric = next(iter(RATE_CHARTS))
+    template = build_rate_figure(cube.mean(cube.dimensions[0], any_metric), any_metric).layout.template
+    return {
+        'version': cube.version,
+        'metrics': metrics,
+        'charts': {metric: {'title': title, 'yaxis_title': yaxis_title} for metric, (title, yaxis_title) in RATE_CHARTS.items()},
+        'template': template.to_plotly_json(),
+    }
+
+
+def store(cube):
+    return dcc.Store(id=STORE_ID, data=store_data(cube))
+
+
+def register(dash_app, charts, cube=None, refresh=None):
+    """Draw each (graph id, dropdown id, metric) in charts from the store, in the browser.
+
+    With a refresh Input, the store is rebuilt from cube on the server whenever it fires.
+    """
+    if refresh is not None:
+        def refresh_rate_aggregates(_):
+            return store_data(cube)
+
+        dash_app.callback(Output(STORE_ID, 'data'), refresh, prevent_initial_call=True)(refresh_rate_aggregates)
+    for graph_id, dropdown_id, metric in charts:
+        dash_app.clientside_callback(
+            'function(dimension, store) {{ return ({})(dimension, store, {}); }}'.format(DRAW_RATE_FIGURE.strip(), json.dumps(metric)),
+            Output(graph_id, 'figure'),
+            Input(dropdown_id, 'value'),
+            Input(STORE_ID, 'data'),
+        )
@@ -0,0 +1,180 @@
+# Filtering the swipe/match charts by any combination of dimensions, through per-category row indexes
+#
+# CrossfilterIndex keeps, for every dimension, the sorted row ids of each category (its postings) and
+# the category code of every row, plus the metric columns. A selection (labels allowed per dimension,
+# ORed within a dimension and ANDed across them) is resolved by set intersection: the postings of the
+# most selective dimension are the candidates, and each other dimension keeps the candidates whose code
+# it allows, a lookup per candidate. Grouping the result is a bincount over the selected rows. So a
+# selection costs time proportional to the rows of its most selective dimension, never a scan of the
+# table. update() appends ingested rows into arrays that grow by doubling, so it costs what it adds.
+# The percentile, box and histogram charts sketch the selected rows the same way (see sketches.py).
+#
+# Unfiltered charts keep coming from the AggregateCube. Filters need every row in memory, so they are
+# offered with server-side charts built from df, not with CLIENTSIDE_CHARTS or AGGREGATES_SOURCE.
+
+import os
+import threading
+
+import dash_bootstrap_components as dbc
+import numpy as np
+import pandas as pd
+from dash import dcc
+from dash.dependencies import ALL, Input
+
+import sketches
+from aggregates import DIMENSIONS, METRICS
+
+ENABLED = os.environ.get('CROSSFILTER', '1') == '1'
+
+
+class _Column:
+    """A 1-d array that grows by doubling, so an append costs what it appends.
+
+    Readers hold views of what was there when they looked, which appends never change.
+    """
+
+    def __init__(self, values):
+        self._data = np.asarray(values)
+        self.size = len(self._data)
+
+    def append(self, values):
+        end = self.size + len(values)
+        if end > len(self._data):
+            data = np.empty(max(end, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        return self._data[:self.size]
+
+
+def _plain(label):
+    return label.item() if hasattr(label, 'item') else label
+
+
+class CrossfilterIndex:
+    def __init__(self, df, dimensions=DIMENSIONS, metrics=METRICS):
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        self.version = 0
+        self.labels = {}
+        self.codes = {}
+        self.postings = {}
+        for dimension in self.dimensions:
+            categorical = df[dimension].astype('category')
+            self.labels[dimension] = [_plain(label) for label in categorical.cat.categories]
+            codes = categorical.cat.codes.to_numpy().astype('int32')
+            self.codes[dimension] = _Column(codes)
+            self.postings[dimension] = [_Column(rows) for rows in self._postings(codes, len(self.labels[dimension]))]
+        self.values = {metric: _Column(df[metric].to_numpy(dtype='float32', na_value=np.nan)) for metric in self.metrics}
+        self.rows = len(df)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _postings(codes, categories, offset=0):
+        """Sorted row ids (plus offset) of each category code."""
+        order = np.argsort(codes, kind='stable').astype('int32')
+        bounds = np.searchsorted(codes[order], np.arange(categories + 1) - 0.5)
+        # codes of -1 (missing labels) sort first and fall before bounds[0]
+        return [order[bounds[i]:bounds[i + 1]] + offset for i in range(categories)]
+
+    def update(self, df):
+        """Append the rows of df. Readers see them once all columns and postings have them."""
+        if len(df) == 0:
+            return self.version
+        with self._lock:
+            offset = self.rows
+            for dimension in self.dimensions:
+                labels = self.labels[dimension]
+                for label in df[dimension].dropna().unique():
+                    if _plain(label) not in labels:
+                        labels.append(_plain(label))
+                        self.postings[dimension].append(_Column(np.empty(0, dtype='int32')))
+                codes = pd.Categorical(df[dimension].astype(object), categories=labels).codes.astype('int32')
+                self.codes[dimension].append(codes)
+                for code, rows in enumerate(self._postings(codes, len(labels), offset)):
+                    if len(rows):
+                        self.postings[dimension][code].append(rows)
+            for metric in self.metrics:
+                self.values[metric].append(df[metric].to_numpy(dtype='float32', na_value=np.nan))
+            self.rows += len(df)
+            self.version += 1
+            return self.version
+
+    def _allowed(self, dimension, values):
+        lookup = {label: code for code, label in enumerate(self.labels[dimension])}
+        return [lookup[value] for value in values if value in lookup]
+
+    def select(self, filters):
+        """Sorted ids of the rows matching filters, a sequence of (dimension, allowed labels)."""
+        rows_seen = self.rows
+        filters = [(dimension, self._allowed(dimension, values)) for dimension, values in filters]
+        if not filters:
+            return np.arange(rows_seen)
+
+        def size(item):
+            dimension, codes = item
+            return sum(self.postings[dimension][code].size for code in codes)
+
+        filters.sort(key=size)
+        (dimension, codes), rest = filters[0], filters[1:]
+        rows = [self.postings[dimension][code].view() for code in codes]
+        rows = np.sort(np.concatenate(rows)) if len(rows) > 1 else (rows[0] if rows else np.empty(0, dtype='int32'))
+        rows = rows[:np.searchsorted(rows, rows_seen)]
+        for dimension, codes in rest:
+            allowed = np.zeros(len(self.labels[dimension]) + 1, dtype=bool)  # the extra slot is code -1
+            allowed[codes] = True
+            rows = rows[allowed[self.codes[dimension].view()[rows]]]
+        return rows
+
+    def mean(self, dimension, metric, filters=()):
+        """Like df[selection].groupby(dimension)[metric].mean(), for the rows select(filters) picks."""
+        rows = self.select(filters)
+        labels = list(self.labels[dimension])
+        codes = self.codes[dimension].view()[rows]
+        values = self.values[metric].view()[rows].astype('float64')
+        grouped = codes >= 0
+        present = np.bincount(codes[grouped], minlength=len(labels)) > 0
+        valid = grouped & ~np.isnan(values)
+        sums = np.bincount(codes[valid], weights=values[valid], minlength=len(labels))
+        counts = np.bincount(codes[valid], minlength=len(labels))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = pd.Series(sums / counts, index=pd.Index(labels, name=dimension), name=metric)
+        return means[present].sort_index()
+
+    def bucket_counts(self, dimension, metric, filters=()):
+        """(labels, sketch bucket counts) of metric for each group of dimension, over the rows select(filters) picks."""
+        rows = self.select(filters)
+        labels = list(self.labels[dimension])
+        codes = self.codes[dimension].view()[rows]
+        values = self.values[metric].view()[rows].astype('float64')
+        present = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=len(labels)))
+        return [labels[i] for i in present], sketches.bucket_counts(codes, values, len(labels))[present]
+
+
+def filter_id(prefix, dimension=ALL):
+    return {'type': prefix + '-filter', 'dimension': dimension}
+
+
+def controls(prefix, index):
+    """A multi-select dropdown per dimension of index, whose values arrive in dimension order."""
+    return dbc.Row([
+        dbc.Col(dcc.Dropdown(
+            options=[{'label': str(label), 'value': label} for label in sorted(index.labels[dimension], key=str)],
+            id=filter_id(prefix, dimension), multi=True, placeholder=dimension,
+        ), width=4)
+        for dimension in index.dimensions
+    ])
+
+
+def filter_input(prefix):
+    return Input(filter_id(prefix), 'value')
+
+
+def selection(dimensions, filter_values):
+    """Hashable ((dimension, allowed labels), ...) of the non-empty filters, or None when there are none."""
+    selected = tuple((dimension, tuple(sorted(values, key=str)))
+                     for dimension, values in zip(dimensions, filter_values or []) if values)
+    return selected or None
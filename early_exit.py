@@ -0,0 +1,229 @@
+# Early-exit inference: stop running BERT layers once an opening line is confidently classified
+#
+# A small head (a pooler and classifier shaped like the model's own) reads the [CLS] state after each
+# intermediate encoder layer. At inference, rows of a batch whose head is at least
+# EARLY_EXIT_THRESHOLD confident leave the batch with that head's prediction, and only the rest run
+# the next layer; rows no head is sure of run all 12 layers and get the full model's prediction. Easy
+# lines like "hey" cost a few layers, hard ones cost what they did before.
+#
+# The heads are fitted to the existing bert_classifier.pth rather than trained on labels: the BERT
+# weights stay frozen and each head learns to reproduce the full model's probabilities (self-distillation)
+# on a set of unlabeled opening lines. Calibrating prints, per threshold, the average layers run and how
+# often the early-exit prediction agrees with the full model on held-out lines, to pick a threshold:
+#
+#   python early_exit.py --texts lines.csv [--text-column text] [--output bert_classifier_exits.pth]
+#
+# Then INFERENCE_MODE=early_exit loads the heads from EARLY_EXIT_HEADS. The layers run per text are
+# exported as the inference_exit_layer histogram on /metrics.
+
+import argparse
+import os
+import time
+
+import torch
+from torch import nn
+
+import metrics
+from inference import classify_batch, load_classifier
+
+HEADS_PATH = os.environ.get('EARLY_EXIT_HEADS', 'bert_classifier_exits.pth')
+THRESHOLD = float(os.environ.get('EARLY_EXIT_THRESHOLD', 0.95))
+THRESHOLDS = (0.8, 0.9, 0.95, 0.98, 0.99)
+
+
+def _attention_mask(attention_mask, dtype):
+    # the additive mask BERT's attention expects: 0 for tokens, the dtype's minimum for padding
+    return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+
+def _run_layer(layer, hidden, mask):
+    output = layer(hidden, attention_mask=mask)
+    # a tuple in older transformers, the hidden states alone in newer ones
+    return output[0] if isinstance(output, tuple) else output
+
+
+def exit_head(model):
+    """A head for an intermediate layer, starting out as the model's own pooler and classifier."""
+    hidden_size, num_classes = model.fc.in_features, model.fc.out_features
+    head = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.Tanh(), nn.Linear(hidden_size, num_classes))
+    head[0].load_state_dict(model.bert.pooler.dense.state_dict())
+    head[2].load_state_dict(model.fc.state_dict())
+    return head
+
+
+class EarlyExitClassifier(nn.Module):
+    """A BERTClassifier that stops at the first layer whose head is at least threshold confident.
+
+    Called like the classifier, it returns the logits of whichever head each row exited at, so
+    classify_batch works with it unchanged.
+    """
+
+    def __init__(self, model, heads, threshold=THRESHOLD):
+        super(EarlyExitClassifier, self).__init__()
+        self.model = model
+        self.heads = heads
+        self.threshold = threshold
+        self.texts = 0
+        self.layers_run = 0
+
+    def forward(self, input_ids, attention_mask):
+        bert = self.model.bert
+        layers = bert.encoder.layer
+        hidden = bert.embeddings(input_ids=input_ids)
+        mask = _attention_mask(attention_mask, hidden.dtype)
+        lengths = attention_mask.sum(dim=1)
+        rows = torch.arange(len(input_ids))
+        logits = hidden.new_empty((len(input_ids), self.model.fc.out_features))
+        for depth, layer in enumerate(layers, 1):
+            hidden = _run_layer(layer, hidden, mask)
+            if depth == len(layers):
+                logits[rows] = self.model.fc(self.model.dropout(bert.pooler(hidden)))
+                self._exited(depth, len(rows))
+                break
+            head = self.heads[str(depth)] if str(depth) in self.heads else None
+            if head is None:
+                continue
+            head_logits = head(hidden[:, 0])
+            confident = torch.softmax(head_logits, dim=1).max(dim=1).values >= self.threshold
+            if not confident.any():
+                continue
+            logits[rows[confident]] = head_logits[confident]
+            self._exited(depth, int(confident.sum()))
+            remaining = ~confident
+            if not remaining.any():
+                break
+            rows, hidden, mask = rows[remaining], hidden[remaining], mask[remaining]
+            # padding is on the right, so the rows left only need their own longest length
+            longest = int(lengths[rows].max())
+            hidden, mask = hidden[:, :longest], mask[..., :longest]
+        return logits
+
+    def _exited(self, depth, count):
+        self.texts += count
+        self.layers_run += depth * count
+        for _ in range(count):
+            metrics.INFERENCE_EXIT_LAYER.observe(depth)
+
+    def average_layers(self):
+        return self.layers_run / self.texts if self.texts else None
+
+
+def load_heads(model, path=HEADS_PATH):
+    saved = torch.load(path, map_location='cpu', weights_only=True)
+    if saved['hidden_size'] != model.fc.in_features or saved['num_classes'] != model.fc.out_features:
+        raise ValueError('{} was calibrated for a different model'.format(path))
+    heads = nn.ModuleDict({str(layer): exit_head(model) for layer in saved['layers']})
+    heads.load_state_dict(saved['heads'])
+    return heads.eval()
+
+
+def from_env(model):
+    """The classifier with the heads at EARLY_EXIT_HEADS, exiting at EARLY_EXIT_THRESHOLD."""
+    if not os.path.exists(HEADS_PATH):
+        raise FileNotFoundError('{} not found: calibrate exit heads with `python early_exit.py --texts ...` '
+                                'or set EARLY_EXIT_HEADS'.format(HEADS_PATH))
+    return EarlyExitClassifier(model.eval(), load_heads(model), THRESHOLD).eval()
+
+
+def layer_states(model, tokenizer, texts, batch_size=32, max_length=128):
+    """([CLS] state after every layer but the last, shaped (texts, layers - 1, hidden), full model probabilities)."""
+    bert = model.eval().bert
+    states, probabilities = [], []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            encoding = tokenizer(texts[start:start + batch_size], max_length=max_length, truncation=True,
+                                 padding='longest', return_tensors='pt')
+            hidden = bert.embeddings(input_ids=encoding['input_ids'])
+            mask = _attention_mask(encoding['attention_mask'], hidden.dtype)
+            cls = []
+            for layer in bert.encoder.layer:
+                hidden = _run_layer(layer, hidden, mask)
+                cls.append(hidden[:, 0])
+            states.append(torch.stack(cls[:-1], dim=1))
+            probabilities.append(torch.softmax(model.fc(bert.pooler(hidden)), dim=1))
+    return torch.cat(states), torch.cat(probabilities)
+
+
+def calibrate(model, states, teacher, epochs=30, batch_size=64, lr=1e-3, seed=0):
+    """Heads for every intermediate layer, fitted to the full model's probabilities."""
+    torch.manual_seed(seed)
+    heads = nn.ModuleDict({str(layer): exit_head(model) for layer in range(1, states.shape[1] + 1)})
+    optimizer = torch.optim.Adam(heads.parameters(), lr=lr)
+    for _ in range(epochs):
+        for batch in torch.randperm(len(states)).split(batch_size):
+            loss = sum(-(teacher[batch] * torch.log_softmax(heads[str(layer)](states[batch, layer - 1]), dim=1)).sum(dim=1).mean()
+                       for layer in range(1, states.shape[1] + 1))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return heads.eval()
+
+
+def exit_report(heads, states, teacher, thresholds=THRESHOLDS):
+    """(threshold, average layers run, agreement with the full model) from precomputed layer states."""
+    total_layers = states.shape[1] + 1
+    full = teacher.argmax(dim=1)
+    with torch.no_grad():
+        head_probabilities = [torch.softmax(heads[str(layer)](states[:, layer - 1]), dim=1)
+                              for layer in range(1, total_layers)]
+    rows = []
+    for threshold in thresholds:
+        depth = torch.full((len(states),), total_layers)
+        preds = full.clone()
+        for layer in range(total_layers - 1, 0, -1):
+            confidence, pred = head_probabilities[layer - 1].max(dim=1)
+            exits = confidence >= threshold
+            depth[exits], preds[exits] = layer, pred[exits]
+        rows.append((threshold, depth.float().mean().item(), (preds == full).float().mean().item()))
+    return rows
+
+
+def main():
+    import pandas as pd
+    from transformers import BertTokenizerFast
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts', required=True, help='CSV of unlabeled opening lines')
+    parser.add_argument('--text-column', default='text')
+    parser.add_argument('--checkpoint', default='bert_classifier.pth')
+    parser.add_argument('--model-name', default='bert-base-uncased')
+    parser.add_argument('--output', default=HEADS_PATH)
+    parser.add_argument('--max-texts', type=int, default=5000)
+    parser.add_argument('--held-out', type=float, default=0.2, help='fraction of the texts kept for the report')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--thresholds', type=float, nargs='+', default=list(THRESHOLDS))
+    args = parser.parse_args()
+
+    texts = pd.read_csv(args.texts)[args.text_column].dropna().astype(str).drop_duplicates()
+    texts = texts.sample(frac=1, random_state=0).head(args.max_texts).tolist()
+    split = int(len(texts) * (1 - args.held_out))
+    model = load_classifier(args.checkpoint, args.model_name)
+    tokenizer = BertTokenizerFast.from_pretrained(args.model_name)
+
+    start = time.perf_counter()
+    states, teacher = layer_states(model, tokenizer, texts)
+    heads = calibrate(model, states[:split], teacher[:split], epochs=args.epochs)
+    print('calibrated {} heads on {} lines in {:.0f}s'.format(len(heads), split, time.perf_counter() - start))
+    torch.save({'layers': [int(layer) for layer in heads], 'heads': heads.state_dict(),
+                'hidden_size': model.fc.in_features, 'num_classes': model.fc.out_features}, args.output)
+    print('wrote {}'.format(args.output))
+
+    held_out = texts[split:]
+    print('{} held-out lines, {} layers in the full model'.format(len(held_out), states.shape[1] + 1))
+    print('{:>9} {:>14} {:>10} {:>14}'.format('threshold', 'average layers', 'agreement', 'texts/s'))
+    full_start = time.perf_counter()
+    for i in range(0, len(held_out), 16):
+        classify_batch(held_out[i:i + 16], model, tokenizer, torch.device('cpu'))
+    print('{:>9} {:>14} {:>10} {:>14.1f}'.format('full', states.shape[1] + 1, '100.00%',
+                                                 len(held_out) / (time.perf_counter() - full_start)))
+    for threshold, layers, agreement in exit_report(heads, states[split:], teacher[split:], args.thresholds):
+        early = EarlyExitClassifier(model, heads, threshold)
+        early_start = time.perf_counter()
+        for i in range(0, len(held_out), 16):
+            classify_batch(held_out[i:i + 16], early, tokenizer, torch.device('cpu'))
+        print('{:>9} {:>14.2f} {:>10.2%} {:>14.1f}'.format(threshold, layers, agreement,
+                                                           len(held_out) / (time.perf_counter() - early_start)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Figure builders for the dropdown driven charts, and a cache of their serialized JSON
+
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+import metrics
+import sketches
+
+# Title and y axis label of the chart drawn for each metric
+RATE_CHARTS = {
+    'AverageMatchRate': ('Match rate percentage by groups', 'Match rate percentage'),
+    'AveragePercentageSwipeRight': ('Rate of swiping "Right"', 'Swipe right percentage'),
+}
+
+
+def build_empty_figure(metric):
+    """The chart's title over blank axes and a note, for a selection no row matches."""
+    title, _ = RATE_CHARTS[metric]
+    fig = go.Figure()
+    fig.update_layout(title=title, xaxis={'visible': False}, yaxis={'visible': False},
+                      annotations=[{'text': 'No rows match the selected filters', 'showarrow': False,
+                                    'xref': 'paper', 'yref': 'paper', 'x': 0.5, 'y': 0.5, 'font': {'size': 16}}])
+    return fig
+
+
+def build_rate_figure(rate_by_group, metric):
+    # px.bar rejects an empty series, which is what a crossfilter selection matching no rows gives
+    if rate_by_group.empty:
+        return build_empty_figure(metric)
+    title, yaxis_title = RATE_CHARTS[metric]
+    fig = px.bar(rate_by_group, x=rate_by_group.index, y=rate_by_group.values, color=rate_by_group.index, title=title)
+    fig.layout.yaxis.tickformat = ',.0%'
+    fig.update_yaxes(title_text=yaxis_title)
+    return fig
+
+
+def _percent_axis(fig, axis, title):
+    getattr(fig.layout, axis).tickformat = ',.1%'
+    (fig.update_yaxes if axis == 'yaxis' else fig.update_xaxes)(title_text=title)
+    return fig
+
+
+def build_distribution_figure(labels, counts, metric, mode, dimension):
+    """Percentiles, box plots or histograms of metric by dimension, from sketch bucket counts (see sketches.py)."""
+    title, axis_title = RATE_CHARTS[metric]
+    if mode == 'percentiles':
+        table = sketches.quantile_table(labels, counts, sketches.PERCENTILES, dimension)
+        x = [str(label) for label in table.index]
+        fig = go.Figure([go.Scatter(x=x, y=table[q], mode='lines+markers', name='p{:g}'.format(q * 100)) for q in table.columns])
+        fig.update_layout(title=title + ' (percentiles)')
+        return _percent_axis(fig, 'yaxis', axis_title)
+    if mode == 'box':
+        table = sketches.quantile_table(labels, counts, sketches.BOX_QUANTILES, dimension)
+        # whiskers at the 5th and 95th percentiles
+        fig = go.Figure([go.Box(x=[str(label)], lowerfence=[row[0]], q1=[row[1]], median=[row[2]], q3=[row[3]],
+                                upperfence=[row[4]], name=str(label)) for label, row in zip(table.index, table.to_numpy())])
+        fig.update_layout(title=title + ' (5th, 25th, 50th, 75th and 95th percentiles)', showlegend=False)
+        return _percent_axis(fig, 'yaxis', axis_title)
+    if mode == 'histogram':
+        # bins up to the largest 99th percentile of any group, the last bin taking everything above
+        upper = np.nanmax(sketches.quantiles(counts, [0.99]), initial=0) if len(counts) else 0
+        upper = max(np.ceil(upper * 100) / 100, 0.01)
+        edges = np.linspace(0, upper, sketches.HISTOGRAM_BINS + 1)
+        table = sketches.histogram_table(labels, counts, edges, dimension)
+        width = edges[1] - edges[0]
+        fig = go.Figure([go.Bar(x=edges[:-1] + width / 2, y=row, width=width, name=str(label), opacity=0.6)
+                         for label, row in zip(table.index, table.to_numpy())])
+        fig.update_layout(title=title + ' (histogram)', barmode='overlay', legend_title_text=dimension)
+        fig.layout.yaxis.tickformat = ',.0%'
+        fig.update_yaxes(title_text='Share of users')
+        return _percent_axis(fig, 'xaxis', axis_title)
+    raise ValueError('Unknown chart mode {!r}, expected one of {}'.format(mode, ', '.join(sketches.MODES)))
+
+
+class FigureCache:
+    """Bounded LRU of serialized rate figures keyed by (metric, dimension, data version, filters, mode).
+
+    Figures are stored as JSON strings so a hit never goes back through plotly express,
+    and a cached entry can't be mutated by whoever receives it.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def figure(self, cube, metric, dimension, filters=None, mode='mean'):
+        """The figure of cube's means of metric by dimension, or another of sketches.MODES.
+
+        With filters, cube is a crossfilter.CrossfilterIndex and filters a selection() of it.
+        """
+        key = (metric, dimension, cube.version, filters, mode)
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        metrics.cache_lookup('figure', 'miss' if serialized is None else 'hit')
+        if serialized is None:
+            if mode == 'mean':
+                means = cube.mean(dimension, metric) if filters is None else cube.mean(dimension, metric, filters)
+                serialized = build_rate_figure(means, metric).to_json()
+            else:
+                labels, counts = cube.bucket_counts(dimension, metric) if filters is None else cube.bucket_counts(dimension, metric, filters)
+                serialized = build_distribution_figure(labels, counts, metric, mode, dimension).to_json()
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = serialized
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return json.loads(serialized)
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,53 @@
+# Gunicorn settings, picked up automatically from the working directory
+#
+# The app is imported once in the master so model weights are loaded there and shared copy-on-write
+# by the workers (see model_loader.py).
+
+import os
+import shutil
+import signal
+import tempfile
+
+preload_app = True
+timeout = 600
+# Threads per worker: concurrent callbacks are what the inference engine batches, and a streamed
+# /score job holds a thread while the dashboard keeps serving on the others
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Shared by the workers' prometheus_client metrics, so /metrics reports all of them (see metrics.py).
+# Set before the app is preloaded, since prometheus_client reads it at import. This file is executed
+# again on every SIGHUP, so it only creates the directory: on_starting empties it once per master.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'dashboard-metrics'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def on_starting(server):
+    # Drops the files of earlier runs. The app is preloaded before this hook runs, so the files the
+    # master has written since (named <type>_<pid>.db) are kept.
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for name in os.listdir(directory):
+        if os.path.splitext(name)[0].rpartition('_')[2] != str(os.getpid()):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def when_ready(server):
+    # Workers are forked straight after this so charts are served while the model is still loading.
+    # Once it has loaded, SIGHUP makes gunicorn replace them with workers forked from the warm master.
+    from model_loader import LOADERS
+
+    for loader in LOADERS:
+        if loader.on_ready(lambda: os.kill(server.pid, signal.SIGHUP)):
+            server.log.info('Serving while %s loads, workers will be replaced once it is ready', loader.name)
+
+
+def child_exit(server, worker):
+    # drops the worker's live gauges, its counters and histograms keep counting towards the totals
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
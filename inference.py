@@ -0,0 +1,399 @@
+# The opening line classifier and a background engine that batches concurrent requests to it
+
+import os
+import queue
+import threading
+import time
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+from torch import nn
+from transformers import BertModel
+
+import metrics
+
+
+class BERTClassifier(nn.Module):
+    def __init__(self, bert_model_name, num_classes, config=None):
+        super(BERTClassifier, self).__init__()
+        # given a BertConfig, the BERT weights are left as initialized, to be replaced by a checkpoint's
+        self.bert = BertModel(config) if config is not None else BertModel.from_pretrained(bert_model_name)
+        self.dropout = nn.Dropout(0.1)
+        self.fc = nn.Linear(self.bert.config.hidden_size, num_classes)
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
+        pooled_output = outputs.pooler_output
+        x = self.dropout(pooled_output)
+        logits = self.fc(x)
+        return logits
+
+
+def load_classifier(checkpoint='bert_classifier.pth', bert_model_name='bert-base-uncased', num_classes=2):
+    model = BERTClassifier(bert_model_name, num_classes)
+    model.load_state_dict(torch.load(checkpoint, map_location=torch.device('cpu')))
+    model.eval()
+    return model
+
+
+# fp32: the model as trained. int8: Linear layers dynamically quantized to int8, roughly a quarter
+# of the weight memory and faster matmuls on CPU. compiled: a frozen TorchScript trace of the fp32
+# model. early_exit: fp32, stopping at the first layer whose exit head is confident enough (see
+# early_exit.py, which calibrates the heads). Check a mode against fp32 with benchmarks/check_parity.py
+# before switching to it.
+INFERENCE_MODES = ('fp32', 'int8', 'compiled', 'early_exit')
+
+# Longest a request thread waits for its results, so a batch that is lost can't hold the thread forever
+RESULT_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT_SECONDS', 60))
+
+
+def prepare_model(model, mode='fp32'):
+    """The classifier converted for the given inference mode."""
+    model.eval()
+    if mode == 'fp32':
+        return model
+    if mode == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if mode == 'compiled':
+        # traced on a small batch; batch size and sequence length stay dynamic in the graph
+        example = torch.ones((2, 16), dtype=torch.long)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, (example, torch.ones_like(example)), strict=False)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if mode == 'early_exit':
+        # imported here, since early_exit builds on this module
+        import early_exit
+        return early_exit.from_env(model)
+    raise ValueError('Unknown inference mode {!r}, expected one of {}'.format(mode, ', '.join(INFERENCE_MODES)))
+
+
+# Sequences are padded only up to the longest one in their bucket, so short opening lines don't pay
+# for a full max_length attention pass
+LENGTH_BUCKETS = (16, 32, 64, 128)
+
+
+def length_buckets(lengths, boundaries=LENGTH_BUCKETS):
+    """Group positions of lengths by the smallest boundary that fits them."""
+    buckets = {}
+    for i, length in enumerate(lengths):
+        bound = next((b for b in boundaries if length <= b), None)
+        buckets.setdefault(bound, []).append(i)
+    return [buckets[bound] for bound in sorted(buckets, key=lambda b: float('inf') if b is None else b)]
+
+
+def _forward(model, encoding, device):
+    input_ids = encoding['input_ids'].to(device)
+    attention_mask = encoding['attention_mask'].to(device)
+
+    with torch.no_grad():
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+        probs, preds = torch.max(torch.softmax(outputs, dim=1), dim=1)
+    return list(zip(preds.tolist(), probs.tolist()))
+
+
+def classify_batch(texts, model, tokenizer, device, max_length=128, padding='longest'):
+    """Predicted class and its probability for each text.
+
+    Texts are truncated to max_length tokens as before. With padding='longest' they are grouped into
+    length buckets and each bucket is padded only to its own longest sequence; padding='max_length'
+    pads everything to max_length in one pass (the original behaviour).
+    """
+    model.eval()
+    metrics.INFERENCE_BATCH_SIZE.observe(len(texts))
+    started = time.perf_counter()
+    if padding == 'max_length':
+        encoding = tokenizer(texts, return_tensors='pt', max_length=max_length, padding='max_length', truncation=True)
+        tokenized = time.perf_counter()
+        results = _forward(model, encoding, device)
+        metrics.INFERENCE_STAGE_SECONDS.labels('tokenize').observe(tokenized - started)
+        metrics.INFERENCE_STAGE_SECONDS.labels('forward').observe(time.perf_counter() - tokenized)
+        return results
+
+    encoded = tokenizer(texts, max_length=max_length, truncation=True)
+    tokenize = time.perf_counter() - started
+    forward = 0
+    results = [None] * len(texts)
+    for bucket in length_buckets([len(ids) for ids in encoded['input_ids']]):
+        features = [{key: encoded[key][i] for key in encoded} for i in bucket]
+        padded = time.perf_counter()
+        encoding = tokenizer.pad(features, padding='longest', return_tensors='pt')
+        forwarding = time.perf_counter()
+        tokenize += forwarding - padded
+        for i, result in zip(bucket, _forward(model, encoding, device)):
+            results[i] = result
+        forward += time.perf_counter() - forwarding
+    metrics.INFERENCE_STAGE_SECONDS.labels('tokenize').observe(tokenize)
+    metrics.INFERENCE_STAGE_SECONDS.labels('forward').observe(forward)
+    return results
+
+
+class CachedTokenizer:
+    """Wraps a (fast) BERT tokenizer with a bounded LRU of encoded token ids.
+
+    Ids are cached per text, without special tokens. A text that isn't cached but extends a cached
+    one after a space (the usual case while someone types) only has its last word tokenized, since
+    the tokenizer splits on whitespace before anything else. Misses are tokenized in one
+    batched call. Called the way classify_batch calls a tokenizer, it returns the same ids; anything
+    else is passed through.
+    """
+
+    def __init__(self, tokenizer, maxsize=8192, max_tokens=512):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self.max_tokens = max_tokens
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            ids = self._entries.get(key)
+            if ids is not None:
+                self._entries.move_to_end(key)
+            return ids
+
+    def _store(self, key, ids):
+        with self._lock:
+            self._entries[key] = ids
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def encode(self, texts):
+        """Token ids of each text, without special tokens, capped at max_tokens."""
+        keys = list(texts)
+        ids = [self._lookup(key) for key in keys]
+        pending = {}
+        for i, key in enumerate(keys):
+            if ids[i] is not None:
+                self.hits += 1
+                metrics.cache_lookup('tokenizer', 'hit')
+                continue
+            head, _, tail = key.rpartition(' ')
+            head_ids = self._lookup(head) if head else None
+            if head_ids is not None:
+                self.prefix_hits += 1
+                metrics.cache_lookup('tokenizer', 'prefix_hit')
+                pending[i] = (head_ids, tail)
+            else:
+                self.misses += 1
+                metrics.cache_lookup('tokenizer', 'miss')
+                pending[i] = ([], key)
+        if pending:
+            to_encode = [rest for _, rest in pending.values()]
+            encoded = self.tokenizer(to_encode, add_special_tokens=False)['input_ids']
+            for (i, (head_ids, _)), rest_ids in zip(pending.items(), encoded):
+                ids[i] = (head_ids + rest_ids)[:self.max_tokens]
+                self._store(keys[i], ids[i])
+        return ids
+
+    def __call__(self, texts, max_length=128, truncation=True, **kwargs):
+        if kwargs or not truncation or isinstance(texts, str):
+            return self.tokenizer(texts, max_length=max_length, truncation=truncation, **kwargs)
+        cls_id, sep_id = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id
+        input_ids = [[cls_id] + ids[:max_length - 2] + [sep_id] for ids in self.encode(texts)]
+        return {
+            'input_ids': input_ids,
+            'token_type_ids': [[0] * len(ids) for ids in input_ids],
+            'attention_mask': [[1] * len(ids) for ids in input_ids],
+        }
+
+    def pad(self, *args, **kwargs):
+        return self.tokenizer.pad(*args, **kwargs)
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'prefix_hits': self.prefix_hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# Priorities of the engine's queue: interactive requests go first, then bulk batches, then stop()
+INTERACTIVE, BULK, STOP = 0, 1, 2
+
+
+class InferenceEngine:
+    """Coalesces concurrent classify requests into batches on a background thread.
+
+    The first queued request waits at most max_wait_ms for others to join it, and a batch never
+    holds more than max_batch_size texts. Each caller gets its own (class, probability) back
+    through a Future. Bulk batches (classify) run on the same thread, one at a time and only
+    when no interactive request is waiting.
+    """
+
+    def __init__(self, model, tokenizer, device, max_batch_size=16, max_wait_ms=5, max_length=128):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_length = max_length
+        self._queue = queue.PriorityQueue()
+        # ties break in arrival order, so requests of the same priority are never compared
+        self._order = itertools.count()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, model, tokenizer, device):
+        return cls(model, tokenizer, device,
+                   max_batch_size=int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16)),
+                   max_wait_ms=float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5)))
+
+    def _ensure_started(self):
+        # started lazily, and again after a fork, since threads don't survive into gunicorn workers
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.PriorityQueue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), name='inference-engine', daemon=True)
+                self._thread.start()
+
+    def _put(self, priority, item):
+        self._queue.put((priority, next(self._order), item))
+
+    def submit(self, text):
+        self._ensure_started()
+        future = Future()
+        self._put(INTERACTIVE, (text, future))
+        metrics.INFERENCE_QUEUE_DEPTH.set(self._queue.qsize())
+        return future
+
+    def predict(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    def classify(self, texts):
+        """(class, probability) of each text, as one low priority batch (see the class docstring)."""
+        self._ensure_started()
+        batch = [(text, Future()) for text in texts]
+        self._put(BULK, batch)
+        try:
+            return [future.result(RESULT_TIMEOUT) for _, future in batch]
+        finally:
+            # the engine skips a batch nobody is waiting for any more
+            for _, future in batch:
+                future.cancel()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                self._put(STOP, None)
+                self._thread.join()
+            self._thread = None
+
+    def _collect(self, requests):
+        priority, _, first = requests.get()
+        if priority == STOP:
+            return None
+        if priority == BULK:
+            # only at the front of the queue when no interactive request is waiting
+            return first
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] != INTERACTIVE:
+                # a bulk batch or stop(): back in its place, and this batch runs without waiting for more
+                requests.put(item)
+                break
+            batch.append(item[2])
+        metrics.INFERENCE_QUEUE_DEPTH.set(requests.qsize())
+        return batch
+
+    def _run(self, requests):
+        while True:
+            batch = self._collect(requests)
+            if batch is None:
+                return
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        """Classify a batch of (text, future) pairs and resolve the futures."""
+        try:
+            results = classify_batch([text for text, _ in batch], self.model, self.tokenizer, self.device, self.max_length)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def normalize_text(text):
+    # the uncased tokenizer lowercases and splits on whitespace anyway, so this can't change a prediction
+    return ' '.join((text or '').split()).lower()
+
+
+class PredictionCache:
+    """Bounded LRU of (class, probability) results keyed by normalized text, expiring after ttl seconds."""
+
+    def __init__(self, maxsize=4096, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        key = normalize_text(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.cache_lookup('prediction', 'hit')
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            metrics.cache_lookup('prediction', 'miss')
+            return None
+
+    def put(self, text, result):
+        key = normalize_text(text)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class LatestRequestTracker:
+    """Remembers each session's pending prediction and cancels it when the session sends newer text.
+
+    A cancelled Future that is still queued is skipped by the InferenceEngine, so text the user has
+    already typed past never reaches the model.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def replace(self, session_id, future):
+        with self._lock:
+            previous = self._pending.get(session_id)
+            self._pending[session_id] = future
+        if previous is not None and previous.cancel():
+            with self._lock:
+                self.dropped += 1
+
+    def finish(self, session_id, future):
+        with self._lock:
+            if self._pending.get(session_id) is future:
+                del self._pending[session_id]
@@ -0,0 +1,260 @@
+# A pool of inference worker processes sharing one copy of the classifier weights
+#
+# One InferenceEngine thread runs every forward pass of its process, so a web process gets at most the
+# intra-op parallelism of a single batch out of the CPU. With INFERENCE_PROCESSES set, the engine hands
+# its batches to that many worker processes instead, each running INFERENCE_THREADS torch threads
+# (default: the CPU count divided between them), and collects the next batch while they run.
+#
+# The weights are written once to a file in /dev/shm (the temp directory where there is none) and
+# every process maps that file rather than holding its own copy: the process that loaded the model
+# re-points its parameters at the mapping, and workers build the classifier with no weights (on the
+# meta device) and point it at the mapping too. The pages are shared by all of them, so the resident
+# weights stay at ~440MB however many workers run (each worker still has its own interpreter and torch
+# runtime, a few hundred MB that isn't weights). That holds for INFERENCE_MODE=fp32 and early_exit; int8 and
+# compiled convert the weights, and each worker then holds its own converted copy.
+#
+# Workers are separate interpreters (python inference_pool.py), started on first use by each process
+# that serves requests, so a gunicorn worker starts its own pool after it is forked: size
+# gunicorn workers x INFERENCE_PROCESSES x INFERENCE_THREADS to the cores available. Batches and
+# results travel over pipes. A worker that dies fails the batch it was running and is replaced.
+
+import atexit
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from itertools import chain
+from multiprocessing.connection import Connection
+
+import torch
+from torch import nn
+
+from inference import BERTClassifier, CachedTokenizer, InferenceEngine, classify_batch, prepare_model
+
+PROCESSES = int(os.environ.get('INFERENCE_PROCESSES', 0))
+THREADS = int(os.environ.get('INFERENCE_THREADS', 0)) or max(1, (os.cpu_count() or 1) // max(PROCESSES, 1))
+ENABLED = PROCESSES > 0
+WEIGHTS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _remove(path, pid):
+    # only the process that wrote the file removes it, not workers forked from it
+    if os.getpid() == pid:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def map_weights(path):
+    """name -> tensor of every parameter and buffer in a file written by share_weights, memory mapped."""
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def assign_weights(model, tensors):
+    """Point the parameters and buffers of model at tensors, without copying them."""
+    for name, tensor in tensors.items():
+        module_name, _, attr = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    return model
+
+
+def share_weights(model, directory=WEIGHTS_DIR):
+    """Write the weights of model to a file in directory and re-point model at a mapping of it.
+
+    Non-persistent buffers are written too, so a model built on the meta device is complete once
+    assigned. Returns the path, which is removed when this process exits.
+    """
+    fd, path = tempfile.mkstemp(prefix='bert-classifier-', suffix='.pt', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        torch.save({name: tensor.detach() for name, tensor in chain(model.named_parameters(), model.named_buffers())}, f)
+    atexit.register(_remove, path, os.getpid())
+    assign_weights(model, map_weights(path))
+    return path
+
+
+class _Worker:
+    def __init__(self, threads):
+        to_worker, self._to_worker = os.pipe()
+        self._from_worker, from_worker = os.pipe()
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(to_worker), str(from_worker)],
+                                        pass_fds=(to_worker, from_worker), stdin=subprocess.DEVNULL, env=env)
+        os.close(to_worker)
+        os.close(from_worker)
+        self.send = Connection(self._to_worker, readable=False)
+        self.receive = Connection(self._from_worker, writable=False)
+        self.ready = False
+        # the future of the batch it is running and whether it has exited, changed together
+        self.lock = threading.Lock()
+        self.future = None
+        self.dead = False
+
+    def close(self, timeout=5):
+        self.send.close()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class InferencePool(InferenceEngine):
+    """An InferenceEngine whose batches run in worker processes (see the top of this file).
+
+    Requests are coalesced as before; each batch goes to the next free worker, so up to `processes`
+    batches run at once. Bulk batches are queued behind interactive requests as in the engine.
+    """
+
+    def __init__(self, model, tokenizer, device, processes, threads=THREADS, mode='fp32', **kwargs):
+        super(InferencePool, self).__init__(model, tokenizer, device, **kwargs)
+        self.processes = processes
+        self.threads = threads
+        self.mode = mode
+        self.weights = share_weights(model)
+        self._setup = {
+            'weights': self.weights, 'config': model.bert.config, 'num_classes': model.fc.out_features,
+            'mode': mode, 'threads': threads, 'max_length': self.max_length,
+            'tokenizer': tokenizer.tokenizer if isinstance(tokenizer, CachedTokenizer) else tokenizer,
+        }
+        self._workers = []
+        self._free = queue.Queue()
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._failed = None
+
+    @classmethod
+    def from_env(cls, model, tokenizer, device, mode='fp32'):
+        return cls(model, tokenizer, device, PROCESSES, THREADS, mode,
+                   max_batch_size=int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16)),
+                   max_wait_ms=float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5)))
+
+    def _ensure_started(self):
+        super(InferencePool, self)._ensure_started()
+        # like the engine thread, workers belong to the process that started them
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                self._pool_pid = os.getpid()
+                self._free = queue.Queue()
+                self._workers = []
+                for _ in range(self.processes):
+                    self._start_worker()
+
+    def _start_worker(self):
+        worker = _Worker(self.threads)
+        worker.send.send(self._setup)
+        self._workers.append(worker)
+        threading.Thread(target=self._read, args=(worker, os.getpid()), name='inference-pool-reader', daemon=True).start()
+        self._free.put(worker)
+
+    def _read(self, worker, pid):
+        while True:
+            try:
+                status, value = worker.receive.recv()
+            except (EOFError, OSError):
+                break
+            if status == 'ready':
+                worker.ready = True
+                continue
+            with worker.lock:
+                future, worker.future = worker.future, None
+            self._free.put(worker)
+            if status == 'ok':
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+        with worker.lock:
+            worker.dead = True
+            future, worker.future = worker.future, None
+        if future is not None:
+            future.set_exception(RuntimeError('inference worker {} exited'.format(worker.process.pid)))
+        worker.receive.close()
+        worker.process.wait()
+        with self._pool_lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            if self._pool_pid != pid:
+                return
+            if not worker.ready:
+                # a worker that can't even load the model would only fail again
+                self._failed = 'inference worker {} failed to start, exit code {}'.format(worker.process.pid, worker.process.returncode)
+            else:
+                self._start_worker()
+
+    def _send(self, texts):
+        """A Future of the (class, probability) results of texts, from the next free worker."""
+        future = Future()
+        while True:
+            if self._failed:
+                raise RuntimeError(self._failed)
+            try:
+                worker = self._free.get(timeout=1)
+            except queue.Empty:
+                continue
+            # a worker that exits from here on finds the future and fails it; one that already has is skipped
+            with worker.lock:
+                if not worker.dead:
+                    worker.future = future
+                    break
+        try:
+            worker.send.send(texts)
+        except OSError:
+            # the reader sees the worker exit, fails the future and replaces the worker
+            pass
+        return future
+
+    def _dispatch(self, batch):
+        def resolve(done):
+            error = done.exception()
+            for i, (_, future) in enumerate(batch):
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(done.result()[i])
+
+        try:
+            self._send([text for text, _ in batch]).add_done_callback(resolve)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+    def stop(self):
+        super(InferencePool, self).stop()
+        with self._pool_lock:
+            workers, self._workers = self._workers, []
+            self._pool_pid = None
+        for worker in workers:
+            worker.close()
+
+
+def _worker(receive_fd, send_fd):
+    receive = Connection(receive_fd, writable=False)
+    send = Connection(send_fd, readable=False)
+    setup = receive.recv()
+    torch.set_num_threads(setup['threads'])
+    with torch.device('meta'):
+        model = BERTClassifier(None, setup['num_classes'], setup['config'])
+    model = prepare_model(assign_weights(model, map_weights(setup['weights'])), setup['mode'])
+    tokenizer = CachedTokenizer(setup['tokenizer'])
+    device = torch.device('cpu')
+    send.send(('ready', os.getpid()))
+    while True:
+        try:
+            texts = receive.recv()
+        except EOFError:
+            return
+        try:
+            send.send(('ok', classify_batch(texts, model, tokenizer, device, setup['max_length'])))
+        except Exception as e:
+            send.send(('error', repr(e)))
+
+
+if __name__ == '__main__':
+    _worker(int(sys.argv[1]), int(sys.argv[2]))
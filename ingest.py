@@ -0,0 +1,227 @@
+# Live ingestion of new user rows into the chart aggregates
+#
+# With INGEST_DIR set, every process serving the dashboard watches that directory for new CSV files of
+# descriptive_stats rows. Each new file is validated against snapshot.SCHEMAS and folded into the
+# AggregateCube with cube.update(), which only groups the new rows. Files are never moved or modified:
+# the directory is the log of everything ingested since descriptive_stats.csv was built, so every
+# gunicorn worker (and every restart) reads each file once and ends up with the same aggregates.
+# Write files under another name and rename them to *.csv when complete, so half-written files are
+# never picked up. With INGEST_TOKEN also set, POST /ingest (Authorization: Bearer <token>) takes a CSV
+# body or a JSON list of records, validates it and writes it into the directory the same way.
+#
+# start() catches up with the directory once, then the watcher polls it on its own thread, so callbacks
+# never wait on ingestion. register() adds a server callback, driven by a dcc.Interval, publishing
+# cube.rows to a dcc.Store that charts take as an input to redraw within seconds of new rows arriving.
+
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import flask
+from dash import dcc, no_update
+from dash.dependencies import Input, Output, State
+
+from snapshot import SCHEMAS
+
+logger = logging.getLogger(__name__)
+
+INGEST_DIR = os.environ.get('INGEST_DIR', '')
+INGEST_TOKEN = os.environ.get('INGEST_TOKEN', '')
+POLL_SECONDS = float(os.environ.get('INGEST_POLL_SECONDS', 2))
+REFRESH_SECONDS = float(os.environ.get('INGEST_REFRESH_SECONDS', 5))
+ENABLED = bool(INGEST_DIR)
+
+SCHEMA = SCHEMAS['descriptive_stats']
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+INTERVAL_ID = 'ingest-interval'
+ROWS_ID = 'ingest-rows'
+
+TRUE_VALUES = {'true', '1', 'yes'}
+FALSE_VALUES = {'false', '0', 'no'}
+
+
+class IngestError(ValueError):
+    pass
+
+
+def validate(df, schema=SCHEMA):
+    """df reduced to the columns of schema and cast to its dtypes. Raises IngestError listing every problem."""
+    missing = [column for column in schema if column not in df.columns]
+    if missing:
+        raise IngestError('missing columns: {}'.format(', '.join(missing)))
+    problems = []
+    columns = {}
+    for column, dtype in schema.items():
+        values = df[column]
+        if dtype == 'bool':
+            text = values.astype(str).str.strip().str.lower()
+            bad = ~text.isin(TRUE_VALUES | FALSE_VALUES)
+            values = text.isin(TRUE_VALUES)
+        elif dtype.startswith('float'):
+            values = pd.to_numeric(values, errors='coerce')
+            # blank rates are fine (the groupby skips them), anything else must be a rate in [0, 1]
+            bad = (values.isna() & df[column].notna()) | (values < 0) | (values > 1)
+        else:
+            bad = values.notna() & (values.astype(str).str.strip() == '')
+        if bad.any():
+            rows = list(df.index[bad.to_numpy()][:5])
+            problems.append('{}: {} invalid value(s), e.g. at rows {}'.format(column, int(bad.sum()), rows))
+        columns[column] = values
+    if problems:
+        raise IngestError('; '.join(problems))
+    return pd.DataFrame(columns).astype(schema)
+
+
+def read_records(body, content_type):
+    """A DataFrame from a CSV or JSON (list of records) request body."""
+    try:
+        if 'json' in content_type:
+            return pd.DataFrame.from_records(flask.json.loads(body))
+        return pd.read_csv(io.BytesIO(body))
+    except (ValueError, TypeError) as e:
+        raise IngestError('unreadable body: {}'.format(e))
+
+
+def write_drop_file(df, directory=INGEST_DIR):
+    """Atomically add df to the drop directory, where every watcher will pick it up."""
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+    partial = os.path.join(directory, name + '.part')
+    df.to_csv(partial, index=False)
+    os.replace(partial, os.path.join(directory, name + '.csv'))
+    return name + '.csv'
+
+
+class DropDirectoryWatcher:
+    """Polls directory for CSV files not seen before and folds them into cube."""
+
+    def __init__(self, cube, directory=INGEST_DIR, poll_seconds=POLL_SECONDS):
+        self.cube = cube
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self.files = 0
+        self.rows = 0
+        self.rejected = {}
+        self.last_ingest = None
+        # called with every batch of validated rows, after the cube has them
+        self.listeners = []
+        self._seen = set()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # started lazily, and again after a fork, since threads don't survive into gunicorn workers
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='ingest-watcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Polling %s failed', self.directory)
+            time.sleep(self.poll_seconds)
+
+    def poll(self):
+        """Ingest every new file in the directory, oldest name first. Returns the number of rows added."""
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith('.csv'))
+        except FileNotFoundError:
+            return 0
+        new = [name for name in names if name not in self._seen]
+        frames = []
+        for name in new:
+            self._seen.add(name)
+            try:
+                frames.append(validate(pd.read_csv(os.path.join(self.directory, name))))
+            except (OSError, ValueError) as e:
+                logger.warning('Rejected %s: %s', name, e)
+                self.rejected[name] = str(e)
+                continue
+            self.files += 1
+        if not frames:
+            return 0
+        df = pd.concat(frames, ignore_index=True)
+        self.cube.update(df)
+        for listener in self.listeners:
+            listener(df)
+        self.rows += len(df)
+        self.last_ingest = time.time()
+        logger.info('Ingested %d rows from %d files', len(df), len(frames))
+        return len(df)
+
+    def info(self):
+        return {
+            'directory': self.directory,
+            'files': self.files,
+            'rows': self.rows,
+            'cube_rows': self.cube.rows,
+            'cube_version': self.cube.version,
+            'rejected': dict(self.rejected),
+            'last_ingest': self.last_ingest,
+            'pid': os.getpid(),
+        }
+
+
+def start(cube, listeners=()):
+    """Ingest what is already in INGEST_DIR into cube, then keep watching it in the background."""
+    watcher = DropDirectoryWatcher(cube)
+    watcher.listeners.extend(listeners)
+    watcher.poll()
+    watcher.ensure_started()
+    return watcher
+
+
+def layout(cube):
+    """Components register() needs in the layout."""
+    return [dcc.Interval(id=INTERVAL_ID, interval=int(REFRESH_SECONDS * 1000)), dcc.Store(id=ROWS_ID, data=cube.rows)]
+
+
+def register(dash_app, watcher):
+    """Publish the watched cube's row count to ROWS_ID, and serve /ingest-stats and (with INGEST_TOKEN) /ingest.
+
+    Chart callbacks that take Input(ROWS_ID, 'data') re-run when rows have been ingested.
+    """
+    cube = watcher.cube
+    server = dash_app.server
+
+    @dash_app.callback(Output(ROWS_ID, 'data'), Input(INTERVAL_ID, 'n_intervals'), State(ROWS_ID, 'data'))
+    def publish_rows(_, rows):
+        return no_update if rows == cube.rows else cube.rows
+
+    def ingest_stats():
+        return flask.jsonify(watcher.info())
+
+    def too_large():
+        return flask.jsonify({'error': 'body larger than {} bytes'.format(MAX_BODY_BYTES)}), 413
+
+    def ingest_rows():
+        request = flask.request
+        if request.headers.get('Authorization', '') != 'Bearer ' + INGEST_TOKEN:
+            return flask.jsonify({'error': 'unauthorized'}), 401
+        if (request.content_length or 0) > MAX_BODY_BYTES:
+            return too_large()
+        # read one byte past the limit, so a body without Content-Length (chunked) can't be any bigger either
+        body = request.stream.read(MAX_BODY_BYTES + 1)
+        if len(body) > MAX_BODY_BYTES:
+            return too_large()
+        try:
+            df = validate(read_records(body, request.content_type or ''))
+        except IngestError as e:
+            return flask.jsonify({'error': str(e)}), 400
+        name = write_drop_file(df)
+        return flask.jsonify({'file': name, 'rows': len(df)}), 202
+
+    server.before_request(watcher.ensure_started)
+    server.add_url_rule('/ingest-stats', 'ingest_stats', ingest_stats)
+    if INGEST_TOKEN:
+        server.add_url_rule('/ingest', 'ingest_rows', ingest_rows, methods=['POST'])
@@ -0,0 +1,62 @@
+# Serves the Dash layout from bytes serialized and compressed once at startup
+#
+# Dash re-serializes the whole component tree, including the embedded figures, for every _dash-layout
+# request. The layouts here are static, so install() serializes it once, keeps identity, gzip and (when
+# the brotli package is installed) brotli bodies, and answers repeat visitors' If-None-Match with a 304.
+
+import gzip
+import hashlib
+
+import flask
+from plotly.io.json import to_json_plotly
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+class PrecompressedLayout:
+    def __init__(self, layout):
+        body = to_json_plotly(layout).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        # strong ETags name exact bytes, so each encoding gets its own
+        self.variants = {'identity': (body, etag)}
+        self.variants['gzip'] = (gzip.compress(body, compresslevel=9, mtime=0), etag + '-gz')
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body, quality=11), etag + '-br')
+        self.etags = {variant_etag for _, variant_etag in self.variants.values()}
+
+    def sizes(self):
+        return {encoding: len(body) for encoding, (body, _) in self.variants.items()}
+
+    def response(self):
+        request = flask.request
+        held = [etag for etag in request.if_none_match.as_set() if etag in self.etags]
+        if held:
+            response = flask.Response(status=304)
+            response.set_etag(held[0])
+        else:
+            encoding = next((e for e in ENCODINGS if e in self.variants and request.accept_encodings[e]), 'identity')
+            body, etag = self.variants[encoding]
+            response = flask.Response(body, mimetype='application/json')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+            response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+def install(dash_app):
+    """Serve dash_app's current (static) layout through a PrecompressedLayout. Call after setting the layout."""
+    layout = dash_app.layout
+    if callable(layout):
+        return None
+    precompressed = PrecompressedLayout(layout)
+    endpoint = dash_app.config.routes_pathname_prefix + '_dash-layout'
+    dash_app.server.view_functions[endpoint] = precompressed.response
+    return precompressed
@@ -0,0 +1,318 @@
+# Regenerates the emoji and word frequency data of the dashboard from raw message exports
+#
+#   python message_pipeline.py EXPORT [EXPORT ...] [--workers N] [--data-dir Data] [--assets-dir assets]
+#
+# EXPORT is a Tinder / swipestats style JSON export or a directory of them: each profile holds the
+# user's gender and their matches' messages ({"User": {"gender": "M"}, "Messages": [{"messages":
+# [{"message": "hey"}, ...]}, ...]}, keys in either case). A file may hold one profile, a JSON array of
+# them, or one per line (.jsonl/.ndjson). Files are stream-parsed a profile at a time, never loaded whole.
+#
+# Sent messages are counted per gender in a process pool: emoji sequences (skin tones and ZWJ sequences
+# kept together, variation selectors dropped) and lowercased words minus STOPWORDS. The work is split
+# into files, or ranges of lines of a JSONL file, each parsed and counted by a worker; a large JSON array
+# can't be split without parsing it, so it is parsed here and its messages are counted by the workers a
+# batch at a time. At most two tasks per worker are in flight, so memory stays at a few batches plus the
+# counters, however big the exports. Partial counts are merged into:
+#
+#   Data/male_emojis.csv, Data/female_emojis.csv   (emojis, volumes) of the TOP_EMOJIS most used, as before
+#   Data/male_words.csv, Data/female_words.csv     (words, volumes) of the TOP_WORDS most used
+#
+# Snapshots of those tables are rebuilt when pyarrow is installed. With the wordcloud package installed,
+# assets/word_cloud_gender_{M,F}.png are redrawn from the word counts as well; run asset_pipeline.py after.
+
+import argparse
+import html
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+import snapshot
+
+try:
+    from wordcloud import WordCloud
+except ImportError:
+    WordCloud = None
+
+GENDERS = {'m': 'M', 'male': 'M', 'man': 'M', 'f': 'F', 'female': 'F', 'woman': 'F'}
+TABLES = {'M': 'male', 'F': 'female'}
+TOP_EMOJIS = 15
+TOP_WORDS = 1000
+
+JSON_SUFFIXES = ('.json', '.jsonl', '.ndjson')
+BLOCK = 1 << 20
+RANGE_BYTES = 32 * BLOCK
+BATCH_MESSAGES = 20000
+
+# Emoji presentation characters: pictographs, emoticons, transport and supplemental symbols, misc symbols
+# and dingbats, a few stars and arrows, keycaps, and flags (pairs of regional indicators)
+_BASE = '[\u2300-\u23ff\u2600-\u27bf\u2b05-\u2b07\u2b1b\u2b1c\u2b50\u2b55\U0001f004-\U0001f251\U0001f300-\U0001f3fa\U0001f400-\U0001faff]'
+_MODIFIERS = '[\U0001f3fb-\U0001f3ff]?\ufe0f?'
+EMOJI = re.compile('[\U0001f1e6-\U0001f1ff]{2}|[0-9#*]\ufe0f?\u20e3|' + _BASE + _MODIFIERS + '(?:\u200d' + _BASE + _MODIFIERS + ')*')
+WORD = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+
+STOPWORDS = frozenset('''
+a about after again all also am an and any are as at be because been before being but by can could
+did do does doing don't for from had has have having he her here hers him his how i i'd i'll i'm i've
+if in into is isn't it it's its just let's me more most my no nor not now of off on once only or other
+our ours out over own same she should so some such than that that's the their theirs them then there
+these they this those through to too under until up very was we we're were what when where which while
+who whom why will with would you you'd you'll you're you've your yours
+'''.split())
+
+
+def _field(record, name):
+    """record[name], accepting the capitalized key of Tinder's own exports."""
+    if not isinstance(record, dict):
+        return None
+    for key in (name, name.capitalize()):
+        if key in record:
+            return record[key]
+    return None
+
+
+def profile_messages(profile):
+    """(gender, texts of the messages sent) of an export profile, gender 'M', 'F' or None."""
+    gender = _field(_field(profile, 'user'), 'gender') or _field(profile, 'gender')
+    gender = GENDERS.get(str(gender or '').strip().lower())
+    texts = []
+    for match in _field(profile, 'messages') or []:
+        # matches holding their messages, or a flat list of messages
+        messages = _field(match, 'messages')
+        for message in messages if isinstance(messages, list) else [match]:
+            text = _field(message, 'message')
+            if isinstance(text, str):
+                texts.append(text)
+    return gender, texts
+
+
+class Counts:
+    """Emoji and word counters per gender, mergeable across workers."""
+
+    def __init__(self):
+        self.profiles = 0
+        self.messages = Counter()
+        self.emojis = {gender: Counter() for gender in TABLES}
+        self.words = {gender: Counter() for gender in TABLES}
+
+    def add(self, gender, texts):
+        self.profiles += 1
+        if gender not in TABLES:
+            return
+        self.messages[gender] += len(texts)
+        emojis, words = self.emojis[gender], self.words[gender]
+        for text in texts:
+            # exports escape apostrophes and the like as HTML entities, often curly ones
+            text = html.unescape(text).replace('\u2019', "'")
+            emojis.update(emoji.replace('\ufe0f', '') for emoji in EMOJI.findall(text))
+            words.update(word for word in WORD.findall(text.lower()) if word not in STOPWORDS)
+
+    def merge(self, other):
+        self.profiles += other.profiles
+        self.messages.update(other.messages)
+        for gender in TABLES:
+            self.emojis[gender].update(other.emojis[gender])
+            self.words[gender].update(other.words[gender])
+        return self
+
+
+def iter_json_values(f, block=BLOCK):
+    """The JSON values of a text file holding one, a top-level array of them, or many in a row.
+
+    Reads a block at a time and holds at most one value plus a block in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof, started = '', 0, False, False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,]':
+            position += 1
+        if position < len(buffer) and not started:
+            started = True
+            if buffer[position] == '[':
+                position += 1
+                continue
+        end = None
+        if position < len(buffer):
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+            # a value running to the end of the buffer may continue in the next block
+            if end == len(buffer) and not eof:
+                end = None
+        if end is not None:
+            yield value
+            position = end
+            continue
+        if eof:
+            return
+        # read at least as much as is buffered, so a value spanning many blocks is decoded O(size) times
+        more = f.read(max(block, len(buffer) - position))
+        buffer, position, eof = buffer[position:] + more, 0, not more
+
+
+def count_file(path):
+    counts = Counts()
+    with open(path, encoding='utf-8') as f:
+        for profile in iter_json_values(f):
+            counts.add(*profile_messages(profile))
+    return counts
+
+
+def count_lines(path, start, end):
+    """Counts of the JSONL profiles in bytes start to end of path, which start and end lines."""
+    counts = Counts()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if line.strip():
+                counts.add(*profile_messages(json.loads(line)))
+    return counts
+
+
+def count_messages(batch):
+    counts = Counts()
+    for gender, texts in batch:
+        counts.add(gender, texts)
+    return counts
+
+
+def line_ranges(path, size=RANGE_BYTES):
+    """(start, end) byte ranges of about size bytes covering path, each ending after a newline."""
+    total = os.path.getsize(path)
+    ranges, start = [], 0
+    with open(path, 'rb') as f:
+        while start < total:
+            f.seek(min(start + size, total))
+            if f.tell() < total:
+                f.readline()
+            ranges.append((start, f.tell()))
+            start = f.tell()
+    return ranges
+
+
+def export_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    if filename.endswith(JSON_SUFFIXES):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def _tasks(paths, range_bytes=RANGE_BYTES, batch_messages=BATCH_MESSAGES):
+    """(function, args) tasks covering every export, generated lazily."""
+    for path in export_files(paths):
+        if path.endswith(('.jsonl', '.ndjson')):
+            for start, end in line_ranges(path, range_bytes):
+                yield count_lines, (path, start, end)
+        elif os.path.getsize(path) <= range_bytes:
+            yield count_file, (path,)
+        else:
+            batch, messages = [], 0
+            with open(path, encoding='utf-8') as f:
+                for profile in iter_json_values(f):
+                    batch.append(profile_messages(profile))
+                    messages += len(batch[-1][1])
+                    if messages >= batch_messages:
+                        yield count_messages, (batch,)
+                        batch, messages = [], 0
+            if batch:
+                yield count_messages, (batch,)
+
+
+def count_exports(paths, workers=1, range_bytes=RANGE_BYTES):
+    """Counts merged over every profile in paths, counted by `workers` processes."""
+    total = Counts()
+    tasks = _tasks(paths, range_bytes)
+    if workers <= 1:
+        for function, args in tasks:
+            total.merge(function(*args))
+        return total
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for function, args in tasks:
+            pending.add(pool.submit(function, *args))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    total.merge(future.result())
+        for future in pending:
+            total.merge(future.result())
+    return total
+
+
+def _write_csv(df, path):
+    df.to_csv(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def write_tables(counts, data_dir=snapshot.DATA_DIR, top_emojis=TOP_EMOJIS, top_words=TOP_WORDS):
+    """Write the emoji and word tables of each gender, returning their names."""
+    names = []
+    for gender, prefix in TABLES.items():
+        tables = {
+            prefix + '_emojis': pd.DataFrame(counts.emojis[gender].most_common(top_emojis), columns=['emojis', 'volumes']),
+            prefix + '_words': pd.DataFrame(counts.words[gender].most_common(top_words), columns=['words', 'volumes']),
+        }
+        for name, df in tables.items():
+            _write_csv(df, os.path.join(data_dir, name + '.csv'))
+            names.append(name)
+    if snapshot.pa is not None and os.path.abspath(data_dir) == os.path.abspath(snapshot.DATA_DIR):
+        for name in names:
+            snapshot.build_snapshot(name)
+    return names
+
+
+def draw_word_clouds(counts, assets_dir='assets'):
+    """Redraw assets/word_cloud_gender_{M,F}.png from the word counts, when wordcloud is installed."""
+    if WordCloud is None:
+        return []
+    paths = []
+    for gender in TABLES:
+        if not counts.words[gender]:
+            continue
+        # the size and transparent background of the images they replace
+        cloud = WordCloud(width=800, height=800, mode='RGBA', background_color=None, max_words=200)
+        path = os.path.join(assets_dir, 'word_cloud_gender_{}.png'.format(gender))
+        cloud.generate_from_frequencies(counts.words[gender]).to_file(path)
+        paths.append(path)
+    return paths
+
+
+def main():
+    import resource
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exports', nargs='+', help='export files, or directories of them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--data-dir', default=snapshot.DATA_DIR)
+    parser.add_argument('--assets-dir', default='assets')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = count_exports(args.exports, args.workers)
+    print('{} profiles, {} messages from men and {} from women in {:.1f}s, peak RSS {:.1f} MB'.format(
+        counts.profiles, counts.messages['M'], counts.messages['F'], time.perf_counter() - start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    for name in write_tables(counts, args.data_dir):
+        print('wrote {}'.format(os.path.join(args.data_dir, name + '.csv')))
+    clouds = draw_word_clouds(counts, args.assets_dir)
+    for path in clouds:
+        print('wrote {}'.format(path))
+    if clouds:
+        print('run python asset_pipeline.py to rebuild their variants')
+    elif WordCloud is None:
+        print('wordcloud is not installed, word cloud images left as they are')
+
+
+if __name__ == '__main__':
+    main()
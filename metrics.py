@@ -0,0 +1,131 @@
+# Prometheus metrics for the dashboard, served at /metrics
+#
+# Metrics are prometheus_client objects defined here and updated where the work happens: Dash callback
+# latency (install() times every dispatch to /_dash-update-component), tokenization and forward time in
+# classify_batch, inference queue depth and batch sizes, layers run in early_exit mode, cache hits and misses, and process RSS.
+#
+# Under gunicorn each worker is a separate process, so gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at
+# a directory that prometheus_client shares between them: every worker writes its values there, and
+# /metrics, whichever worker answers it, reports counters and histograms summed over all live workers
+# (gauges per worker). Without that variable set, as under `python app.py`, it reports the one process.
+# Without prometheus_client installed, the metrics below do nothing and /metrics isn't served.
+
+import os
+import time
+
+import flask
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+RSS_INTERVAL = 5
+
+
+class _Noop:
+    """Stands in for a metric when prometheus_client isn't installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _Noop()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+CALLBACK_SECONDS = _metric('Histogram', 'dash_callback_duration_seconds', 'Time to run a Dash callback request',
+                           ['callback', 'status'], buckets=LATENCY_BUCKETS)
+INFERENCE_STAGE_SECONDS = _metric('Histogram', 'inference_stage_duration_seconds', 'Time spent per classify_batch call in each stage',
+                                  ['stage'], buckets=LATENCY_BUCKETS)
+INFERENCE_BATCH_SIZE = _metric('Histogram', 'inference_batch_size', 'Texts per classify_batch call', buckets=BATCH_BUCKETS)
+INFERENCE_EXIT_LAYER = _metric('Histogram', 'inference_exit_layer', 'Encoder layers run per text in early_exit mode',
+                               buckets=tuple(range(1, 13)))
+INFERENCE_QUEUE_DEPTH = _metric('Gauge', 'inference_queue_depth', 'Requests waiting for the inference engine',
+                                multiprocess_mode='livesum')
+CACHE_REQUESTS = _metric('Counter', 'cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+RESIDENT_MEMORY = _metric('Gauge', 'dashboard_resident_memory_bytes', 'Resident set size of each dashboard process',
+                          multiprocess_mode='liveall')
+
+_rss_updated = 0
+
+
+def cache_lookup(cache, result):
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # peak rather than current RSS, the best available off Linux (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def update_resident_memory(force=False):
+    # at most every RSS_INTERVAL seconds per process, so per-request cost stays negligible
+    global _rss_updated
+    now = time.monotonic()
+    if force or now - _rss_updated >= RSS_INTERVAL:
+        _rss_updated = now
+        RESIDENT_MEMORY.set(resident_memory_bytes())
+
+
+def exposition():
+    """(body, content type) of every metric, summed over gunicorn workers in multiprocess mode."""
+    if MULTIPROCESS:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def install(dash_app):
+    """Time every Dash callback dispatch, keep RSS current, and serve /metrics."""
+    if prometheus_client is None:
+        return
+    server = dash_app.server
+    endpoint = dash_app.config.routes_pathname_prefix + '_dash-update-component'
+    dispatch = server.view_functions[endpoint]
+
+    def timed_dispatch():
+        started = time.perf_counter()
+        body = flask.request.get_json(silent=True) or {}
+        entry = dash_app.callback_map.get(body.get('output'))
+        name = getattr(entry['callback'], '__name__', 'unknown') if entry else 'unknown'
+        status = 'error'
+        try:
+            response = dispatch()
+            # 204 is PreventUpdate, or every output no_update
+            status = str(getattr(response, 'status_code', 200))
+            return response
+        finally:
+            CALLBACK_SECONDS.labels(name, status).observe(time.perf_counter() - started)
+
+    def metrics():
+        update_resident_memory(force=True)
+        body, content_type = exposition()
+        return flask.Response(body, content_type=content_type)
+
+    server.view_functions[endpoint] = timed_dispatch
+    server.before_request(update_resident_memory)
+    server.add_url_rule('/metrics', 'metrics', metrics)
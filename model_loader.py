@@ -0,0 +1,82 @@
+# Background, load-once model loading that gunicorn workers can share copy-on-write
+#
+# The app module creates a ModelLoader and calls start() at import, which loads the model on a
+# background thread so the dashboard can bind its port and serve charts straight away. Under gunicorn
+# with preload_app (see gunicorn.conf.py) that import happens in the master, so the weights are loaded
+# there exactly once. Workers forked while it is still loading report "loading" and leave the chatbot
+# disabled; when the master finishes it sends itself SIGHUP, and gunicorn gracefully replaces them with
+# workers forked from the master, which share the loaded weights copy-on-write instead of each holding
+# a private copy.
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# every loader created in this process, so gunicorn hooks can find them
+LOADERS = []
+
+
+class ModelNotReady(Exception):
+    pass
+
+
+class ModelLoader:
+    def __init__(self, name, load):
+        self.name = name
+        self.state = 'cold'
+        self.value = None
+        self.error = None
+        self.load_seconds = None
+        self._load = load
+        self._callbacks = []
+        self._lock = threading.Lock()
+        LOADERS.append(self)
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def start(self):
+        with self._lock:
+            if self.state != 'cold':
+                return
+            self.state = 'loading'
+        threading.Thread(target=self._run, name='load-' + self.name, daemon=True).start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            value = self._load()
+        except Exception as e:
+            logger.exception('Loading %s failed', self.name)
+            with self._lock:
+                self.error = repr(e)
+                self.state = 'failed'
+            return
+        with self._lock:
+            self.value = value
+            self.load_seconds = time.perf_counter() - started
+            self.state = 'ready'
+            callbacks, self._callbacks = self._callbacks, []
+        logger.info('Loaded %s in %.1fs', self.name, self.load_seconds)
+        for callback in callbacks:
+            callback()
+
+    def on_ready(self, callback):
+        """Run callback once loading finishes. Returns False, without calling it, if it already has."""
+        with self._lock:
+            if self.state == 'ready':
+                return False
+            self._callbacks.append(callback)
+            return True
+
+    def get(self):
+        if self.state != 'ready':
+            raise ModelNotReady('{} is {}'.format(self.name, self.state))
+        return self.value
+
+    def status(self):
+        return {'state': self.state, 'load_seconds': self.load_seconds, 'error': self.error, 'pid': os.getpid()}
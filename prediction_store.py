@@ -0,0 +1,178 @@
+# Opening line predictions persisted on disk, shared by every process on the host
+#
+# The in-memory PredictionCache belongs to one gunicorn worker and is lost on every restart, so a
+# popular line gets scored by each worker and again after each deploy. PredictionStore keeps
+# (class, probability) results in a SQLite database at PREDICTION_STORE, keyed by the normalized text
+# and the model version: a sha256 of the checkpoint plus the INFERENCE_MODE (for early_exit, also a
+# sha256 of the exit heads and EARLY_EXIT_THRESHOLD, which change its predictions too). Workers read
+# and write it concurrently (WAL journal, so readers never wait for a writer), and a restarted dashboard
+# answers lines the store already has without touching BERT, even while the model is still loading.
+# The dashboard opens the store on its model loading thread, so hashing a checkpoint never holds up
+# startup; until open() completes the store is unavailable and every lookup is a miss.
+#
+# The checksum of a checkpoint is remembered with its size and mtime, so a restart with an unchanged
+# model only stats the file. Processes serving different models (another checkpoint or INFERENCE_MODE,
+# a benchmark's test model) can share the file: each reads and writes only its own version's rows, and
+# the rows of models no longer served stop being used and age out. The store holds at most
+# PREDICTION_STORE_MAX_ENTRIES predictions of all versions: on open and every EVICT_EVERY writes, the
+# least recently used beyond that are deleted (last use is recorded at most every TOUCH_SECONDS, so
+# hits rarely write). Database errors are logged and treated as misses, so the store can only ever save
+# work. Set PREDICTION_STORE to an empty string to turn it off.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import metrics
+from inference import normalize_text
+
+logger = logging.getLogger(__name__)
+
+PATH = os.environ.get('PREDICTION_STORE', os.path.join(tempfile.gettempdir(), 'dashboard-predictions.sqlite3'))
+MAX_ENTRIES = int(os.environ.get('PREDICTION_STORE_MAX_ENTRIES', 200000))
+MAX_TEXT_CHARS = 1000
+EVICT_EVERY = 1000
+TOUCH_SECONDS = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS predictions (
+    version TEXT NOT NULL,
+    text TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    probability REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (version, text)
+);
+CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used);
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT NOT NULL
+);
+'''
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionStore:
+    def __init__(self, path=PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.version is not None
+
+    def _connection(self):
+        # one connection per thread, and new ones after a fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def checksum(self, checkpoint):
+        """sha256 of the checkpoint, hashed only when its size or mtime changed since last time."""
+        stat = os.stat(checkpoint)
+        path = os.path.abspath(checkpoint)
+        connection = self._connection()
+        row = connection.execute('SELECT size, mtime_ns, checksum FROM checksums WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        checksum = _sha256(checkpoint)
+        connection.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, checksum))
+        return checksum
+
+    def model_version(self, checkpoint, mode='fp32'):
+        version = '{}:{}'.format(self.checksum(checkpoint), mode)
+        if mode == 'early_exit':
+            import early_exit
+            version += ':{}:{}'.format(self.checksum(early_exit.HEADS_PATH), early_exit.THRESHOLD)
+        return version
+
+    def open(self, checkpoint, mode='fp32'):
+        """Serve the predictions of this checkpoint and inference mode."""
+        if not self.path:
+            return None
+        try:
+            version = self.model_version(checkpoint, mode)
+            evicted = self.evict()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Prediction store %s is unavailable: %s', self.path, e)
+            return None
+        if evicted:
+            logger.info('Evicted %d least recently used stored predictions', evicted)
+        self.version = version
+        return version
+
+    def get(self, text):
+        if not self.enabled:
+            return None
+        key = normalize_text(text)
+        try:
+            connection = self._connection()
+            row = connection.execute('SELECT label, probability, used FROM predictions WHERE version = ? AND text = ?',
+                                     (self.version, key)).fetchone()
+            if row is not None and time.time() - row[2] > TOUCH_SECONDS:
+                connection.execute('UPDATE predictions SET used = ? WHERE version = ? AND text = ?', (time.time(), self.version, key))
+        except sqlite3.Error:
+            logger.exception('Reading the prediction store failed')
+            row = None
+        if row is None:
+            self.misses += 1
+            metrics.cache_lookup('store', 'miss')
+            return None
+        self.hits += 1
+        metrics.cache_lookup('store', 'hit')
+        return row[0], row[1]
+
+    def put(self, text, result):
+        key = normalize_text(text)
+        if not self.enabled or len(key) > MAX_TEXT_CHARS:
+            return
+        label, probability = result
+        try:
+            connection = self._connection()
+            connection.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                               (self.version, key, int(label), float(probability), time.time()))
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self.evict()
+        except sqlite3.Error:
+            logger.exception('Writing the prediction store failed')
+
+    def evict(self):
+        """Delete the least recently used predictions beyond max_entries."""
+        connection = self._connection()
+        excess = connection.execute('SELECT count(*) FROM predictions').fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute('DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY used LIMIT ?)', (excess,))
+        return max(excess, 0)
+
+    def info(self):
+        info = {'hits': self.hits, 'misses': self.misses, 'version': self.version, 'maxsize': self.max_entries, 'size': None}
+        if self.enabled:
+            try:
+                info['size'] = self._connection().execute('SELECT count(*) FROM predictions').fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return info
@@ -0,0 +1,235 @@
+# On-demand sampling profiler for Dash callbacks in production
+#
+# Only installed when PROFILE_TOKEN is set. A callback request is profiled when it carries an
+# X-Profile-Token header equal to PROFILE_TOKEN, or when the admin toggle asks for it:
+#
+#   curl -H "Authorization: Bearer $PROFILE_TOKEN" -d '{"next": 20}' https://.../profiling      the next 20 callbacks
+#   curl -H "Authorization: Bearer $PROFILE_TOKEN" -d '{"percent": 5, "seconds": 600}' .../profiling
+#   curl -H "Authorization: Bearer $PROFILE_TOKEN" -d '{"off": true}' .../profiling
+#   curl -H "Authorization: Bearer $PROFILE_TOKEN" .../profiling                                  status and profiles
+#   curl -H "Authorization: Bearer $PROFILE_TOKEN" .../profiling/<file>                           download one
+#
+# The toggle lives in a small JSON file in PROFILE_DIR, so it applies to every gunicorn worker and "next N"
+# counts callbacks across all of them. While a callback runs, a sampler thread records the stacks of the
+# request thread and the inference engine thread (where the BERT forward pass runs) every
+# PROFILE_INTERVAL_MS, and writes them in collapsed-stack format, one "frame;frame;... count" line per
+# stack, which flamegraph.pl, speedscope and inferno read directly. The oldest profiles are deleted
+# once PROFILE_DIR holds more than PROFILE_MAX_MB. A request that isn't profiled costs a comparison,
+# plus a stat of the toggle file at most once a second.
+
+import fcntl
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import flask
+
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'dashboard-profiles'))
+INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000
+MAX_BYTES = int(float(os.environ.get('PROFILE_MAX_MB', 50)) * 1024 * 1024)
+ENABLED = bool(PROFILE_TOKEN)
+
+HEADER = 'X-Profile-Token'
+CONTROL = 'control.json'
+SUFFIX = '.folded'
+# threads sampled alongside the request thread, by name
+ALSO_SAMPLED = ('inference-engine',)
+
+
+def _frame_label(code, cache={}):
+    label = cache.get(code)
+    if label is None:
+        filename = code.co_filename
+        for prefix in sorted(sys.path, key=len, reverse=True):
+            if prefix and filename.startswith(prefix + os.sep):
+                filename = filename[len(prefix) + 1:]
+                break
+        label = cache[code] = '{} ({})'.format(code.co_name, filename).replace(';', ':')
+    return label
+
+
+def _stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler:
+    """Samples the stacks of a thread (and the ALSO_SAMPLED threads) until stopped."""
+
+    def __init__(self, thread_id, interval=INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        others = {thread.ident: thread.name for thread in threading.enumerate() if thread.name in ALSO_SAMPLED}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, root in [(self.thread_id, 'request')] + list(others.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = root + ';' + _stack(frame)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def folded(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+class Control:
+    """The admin toggle, shared by every process through PROFILE_DIR/control.json."""
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.path = os.path.join(directory, CONTROL)
+        self._state = {}
+        self._mtime = None
+        self._checked = 0
+
+    def _locked(self, update):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            result, new_state = update(state)
+            if new_state is not state:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(new_state))
+                self._state = new_state
+            return result
+
+    def set(self, next_calls=0, percent=0, seconds=None):
+        state = {'next': int(next_calls), 'percent': float(percent),
+                 'until': time.time() + seconds if seconds else None}
+        return self._locked(lambda _: (state, state))
+
+    def state(self):
+        return self._locked(lambda state: (state, state))
+
+    def _cached(self):
+        # a stat at most once a second, and a read only when the file changed
+        now = time.monotonic()
+        if now - self._checked >= 1:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime, self._state = None, {}
+            if mtime is not None and mtime != self._mtime:
+                self._mtime = mtime
+                with open(self.path) as f:
+                    try:
+                        self._state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        self._state = {}
+        return self._state
+
+    def should_profile(self):
+        state = self._cached()
+        if not state.get('next') and not state.get('percent'):
+            return False
+        if state.get('until') and time.time() > state['until']:
+            return False
+        if state.get('percent') and random.random() * 100 < state['percent']:
+            return True
+        if not state.get('next'):
+            return False
+
+        def take(state):
+            if state.get('next', 0) <= 0:
+                return False, state
+            return True, dict(state, next=state['next'] - 1)
+
+        return self._locked(take)
+
+
+def write_profile(sampler, name, seconds, directory=PROFILE_DIR, max_bytes=MAX_BYTES):
+    os.makedirs(directory, exist_ok=True)
+    filename = '{}-{}-{}-{:.0f}ms-{:04x}{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(), name, seconds * 1000,
+                                              random.getrandbits(16), SUFFIX)
+    path = os.path.join(directory, filename)
+    with open(path, 'w') as f:
+        f.write(sampler.folded())
+    # oldest first, until the profiles fit in max_bytes
+    profiles = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                      for entry in os.scandir(directory) if entry.name.endswith(SUFFIX))
+    total = sum(size for _, size, _ in profiles)
+    for _, size, old in profiles:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+        total -= size
+    return filename
+
+
+def install(dash_app):
+    """Profile Dash callback dispatches on demand, and serve the /profiling toggle. Needs PROFILE_TOKEN."""
+    if not ENABLED:
+        return None
+    server = dash_app.server
+    endpoint = dash_app.config.routes_pathname_prefix + '_dash-update-component'
+    dispatch = server.view_functions[endpoint]
+    control = Control()
+
+    def profiled_dispatch():
+        request = flask.request
+        if request.headers.get(HEADER) != PROFILE_TOKEN and not control.should_profile():
+            return dispatch()
+        body = request.get_json(silent=True) or {}
+        entry = dash_app.callback_map.get(body.get('output'))
+        name = getattr(entry['callback'], '__name__', 'unknown') if entry else 'unknown'
+        started = time.perf_counter()
+        with Sampler(threading.get_ident()) as sampler:
+            response = dispatch()
+        write_profile(sampler, name, time.perf_counter() - started)
+        return response
+
+    def authorized():
+        return flask.request.headers.get('Authorization', '') == 'Bearer ' + PROFILE_TOKEN
+
+    def profiling():
+        if not authorized():
+            return flask.jsonify({'error': 'unauthorized'}), 401
+        if flask.request.method == 'POST':
+            options = flask.request.get_json(force=True, silent=True) or {}
+            if options.get('off'):
+                control.set()
+            else:
+                control.set(options.get('next', 0), options.get('percent', 0), options.get('seconds'))
+        state = control.state()
+        profiles = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(SUFFIX))
+        return flask.jsonify({'control': state, 'profiles': profiles, 'pid': os.getpid()})
+
+    def profile_file(filename):
+        if not authorized():
+            return flask.jsonify({'error': 'unauthorized'}), 401
+        return flask.send_from_directory(PROFILE_DIR, filename, mimetype='text/plain')
+
+    server.view_functions[endpoint] = profiled_dispatch
+    server.add_url_rule('/profiling', 'profiling', profiling, methods=['GET', 'POST'])
+    server.add_url_rule('/profiling/<path:filename>', 'profile_file', profile_file)
+    return control
@@ -0,0 +1,154 @@
+# Mergeable distribution sketches of the swipe/match rates, behind the percentile, box and histogram charts
+#
+# Every group of every dimension keeps a histogram of each metric over fixed logarithmic buckets (the
+# bucketing of DDSketch): bucket 0 holds [0, MIN_VALUE) and bucket i > 0 holds [MIN_VALUE * GAMMA**(i-1),
+# MIN_VALUE * GAMMA**i), up to 1 (the rates' maximum, larger values are counted in the top bucket). That
+# is BUCKETS counts per group and metric whatever the number of rows, built in one bincount pass, updated
+# by adding the counts of new rows, and merged by adding counts, so partial sketches built in chunks or
+# processes combine exactly into the sketch of the whole table.
+#
+# Error bounds, with ALPHA = 1%:
+#   quantiles   the value reported for quantile q is within ALPHA relative error (MIN_VALUE/2 absolute
+#               below MIN_VALUE) of the value of rank floor(q * (count - 1)) in the group, since each
+#               bucket is reported by a value at most ALPHA away from everything in it
+#   histograms  each value is counted in the display bin of its bucket's value, so only values within
+#               ALPHA of a bin edge can land in the neighbouring bin; counts per group are exact
+#
+# Charts read the sketch of AggregateCube.distributions unfiltered, and sketch the selected rows of a
+# CrossfilterIndex (with the same bounds) when filtered.
+
+import math
+
+import numpy as np
+import pandas as pd
+from dash import dcc
+from dash.dependencies import Input
+
+ALPHA = 0.01
+MIN_VALUE = 1e-4
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+EDGES = np.concatenate([[0.0], MIN_VALUE * GAMMA ** np.arange(math.ceil(math.log(1 / MIN_VALUE, GAMMA)) + 1)])
+BUCKETS = len(EDGES)
+# the value reported for each bucket: 0 for the first, then the one at most ALPHA from both ends
+VALUES = np.concatenate([[0.0], 2 * EDGES[1:] * GAMMA / (1 + GAMMA)])
+
+# Chart modes offered next to the swipe/match dropdowns, and the quantiles each one draws
+MODES = {'mean': 'Mean', 'percentiles': 'Percentiles', 'box': 'Box plot', 'histogram': 'Histogram'}
+PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+BOX_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+HISTOGRAM_BINS = 20
+
+
+def bucket_index(values):
+    return np.searchsorted(EDGES, values, side='right') - 1
+
+
+def bucket_counts(codes, values, groups):
+    """(groups, BUCKETS) counts of values by group code, leaving out NaN values and codes below 0."""
+    valid = (codes >= 0) & ~np.isnan(values)
+    flat = codes[valid].astype('int64') * BUCKETS + bucket_index(values[valid])
+    return np.bincount(flat, minlength=groups * BUCKETS).reshape(groups, BUCKETS)
+
+
+def quantiles(counts, qs):
+    """(groups, len(qs)) values at quantiles qs of each row of counts, NaN where a row is empty."""
+    cumulative = counts.cumsum(axis=1)
+    total = cumulative[:, -1:]
+    ranks = np.floor(np.asarray(qs, dtype='float64') * np.maximum(total - 1, 0))
+    buckets = (cumulative[:, None, :] <= ranks[:, :, None]).sum(axis=2)
+    result = VALUES[np.minimum(buckets, BUCKETS - 1)]
+    result[total[:, 0] == 0] = np.nan
+    return result
+
+
+def histogram(counts, edges):
+    """(groups, len(edges) - 1) counts of each row of counts per bin of edges, the last bin open ended."""
+    bins = np.clip(np.searchsorted(edges, VALUES, side='right') - 1, 0, len(edges) - 2)
+    assignment = np.zeros((BUCKETS, len(edges) - 1), dtype=counts.dtype)
+    assignment[np.arange(BUCKETS), bins] = 1
+    return counts @ assignment
+
+
+class DistributionCube:
+    """Bucket counts of every metric for every group of every dimension (see the top of this file)."""
+
+    def __init__(self, df=None, dimensions=(), metrics=()):
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        # dimension -> (labels, labels x metrics x buckets counts), one tuple so readers never see a mix
+        self.groups = {dimension: ([], np.zeros((0, len(self.metrics), BUCKETS), dtype='int64')) for dimension in self.dimensions}
+        if df is not None:
+            self.update(df)
+
+    @classmethod
+    def from_counts(cls, labels, counts, metrics):
+        """A cube over bucket counts built elsewhere, as {dimension: labels} and {dimension: array}."""
+        cube = cls(None, list(labels), metrics)
+        cube.groups = {dimension: (list(values), counts[dimension]) for dimension, values in labels.items()}
+        return cube
+
+    def _add(self, dimension, labels, counts):
+        """Counts (labels x metrics x buckets) added to a copy of dimension's, with new labels appended."""
+        known, known_counts = self.groups[dimension]
+        index = {label: i for i, label in enumerate(known)}
+        new = [label for label in labels if label not in index]
+        merged = np.concatenate([known_counts, np.zeros((len(new), len(self.metrics), BUCKETS), dtype='int64')])
+        for label in new:
+            index[label] = len(index)
+        np.add.at(merged, [index[label] for label in labels], counts)
+        return known + new, merged
+
+    def update(self, df):
+        """Add the rows of df. Each dimension's labels and counts are replaced in one assignment, never modified."""
+        for dimension in self.dimensions:
+            categorical = df[dimension].astype('category')
+            labels = [_plain(label) for label in categorical.cat.categories]
+            codes = categorical.cat.codes.to_numpy()
+            counts = np.stack([bucket_counts(codes, df[metric].to_numpy(dtype='float64', na_value=np.nan), len(labels))
+                               for metric in self.metrics], axis=1)
+            # only labels with rows become groups, as with groupby(observed=True)
+            present = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=len(labels)))
+            self.groups[dimension] = self._add(dimension, [labels[i] for i in present], counts[present])
+        return self
+
+    def merge(self, other):
+        for dimension in self.dimensions:
+            self.groups[dimension] = self._add(dimension, *other.groups[dimension])
+        return self
+
+    def bucket_counts(self, dimension, metric):
+        """(labels, (groups, BUCKETS) counts) of metric for each group of dimension."""
+        labels, counts = self.groups[dimension]
+        return list(labels), counts[:, self.metrics.index(metric)]
+
+
+def _plain(label):
+    return label.item() if hasattr(label, 'item') else label
+
+
+def quantile_table(labels, counts, qs, name):
+    """Quantiles qs of each group as a DataFrame indexed by sorted labels, without empty groups."""
+    table = pd.DataFrame(quantiles(counts, qs), index=pd.Index(labels, name=name), columns=list(qs))
+    return table.dropna(how='all').sort_index()
+
+
+def histogram_table(labels, counts, edges, name):
+    """Share of each group's values in each bin of edges, indexed by sorted labels."""
+    binned = histogram(counts, edges).astype('float64')
+    totals = binned.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = pd.DataFrame(binned / totals, index=pd.Index(labels, name=name), columns=edges[:-1])
+    return table.dropna(how='all').sort_index()
+
+
+def mode_id(prefix):
+    return prefix + '-chart-mode'
+
+
+def mode_control(prefix):
+    return dcc.RadioItems(options=[{'label': label, 'value': mode} for mode, label in MODES.items()],
+                          value='mean', id=mode_id(prefix), inline=True, inputStyle={'margin': '0 4px 0 12px'})
+
+
+def mode_input(prefix):
+    return Input(mode_id(prefix), 'value')
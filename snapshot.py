@@ -0,0 +1,146 @@
+# Typed, columnar snapshots of the CSVs in Data/
+#
+# Parsing descriptive_stats.csv pulls ~50 string columns into object dtype, while the dashboard only
+# uses eight of them. `python snapshot.py` converts every CSV in Data/ into an uncompressed Arrow
+# (feather) file under Data/snapshots/, typed with SCHEMAS below. load_table() then memory maps the
+# snapshot and reads only the requested columns. A snapshot records the size, mtime and sha256 of
+# the CSV it was built from; if the CSV has changed since (or pyarrow isn't installed) load_table()
+# falls back to reading the CSV with the same projection and dtypes.
+#
+# `python snapshot.py --measure` prints load time and peak RSS of each path in a fresh process.
+
+import hashlib
+import os
+import sys
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = None
+
+DATA_DIR = './Data'
+SNAPSHOT_DIR = os.path.join(DATA_DIR, 'snapshots')
+
+# Columns kept in the snapshot and their dtypes. Tables without an entry are snapshotted whole with
+# the types pandas infers from the CSV.
+SCHEMAS = {
+    'descriptive_stats': {
+        'gender': 'category',
+        'sexuality': 'category',
+        'AgeofUserGroup': 'category',
+        'educationLevel': 'category',
+        'ProfileShowsSchool': 'bool',
+        'ProfileShowsJob': 'bool',
+        'AverageMatchRate': 'float32',
+        'AveragePercentageSwipeRight': 'float32',
+    },
+}
+
+
+def csv_path(name):
+    return os.path.join(DATA_DIR, name + '.csv')
+
+
+def snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIR, name + '.arrow')
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_csv(name, columns=None):
+    schema = SCHEMAS.get(name)
+    if columns is None and schema is not None:
+        columns = list(schema)
+    dtypes = {column: dtype for column, dtype in (schema or {}).items() if columns is None or column in columns}
+    return pd.read_csv(csv_path(name), usecols=columns, dtype=dtypes or None)
+
+
+def build_snapshot(name):
+    source = csv_path(name)
+    stat = os.stat(source)
+    df = read_csv(name)
+    if name not in SCHEMAS:
+        # drop the unnamed index column pandas wrote alongside the data
+        df = df.loc[:, ~df.columns.str.startswith('Unnamed:')]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata.update({
+        b'source_size': str(stat.st_size).encode(),
+        b'source_mtime_ns': str(stat.st_mtime_ns).encode(),
+        b'source_sha256': _sha256(source).encode(),
+    })
+    table = table.replace_schema_metadata(metadata)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    target = snapshot_path(name)
+    feather.write_feather(table, target + '.tmp', compression='uncompressed')
+    os.replace(target + '.tmp', target)
+    return target
+
+
+def is_fresh(name):
+    """True when the snapshot exists and was built from the current CSV."""
+    path = snapshot_path(name)
+    if pa is None or not os.path.exists(path):
+        return False
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    stat = os.stat(csv_path(name))
+    if metadata.get(b'source_size') != str(stat.st_size).encode():
+        return False
+    if metadata.get(b'source_mtime_ns') == str(stat.st_mtime_ns).encode():
+        return True
+    # checkouts and deploys reset mtimes, so only a content change makes the snapshot stale
+    return metadata.get(b'source_sha256') == _sha256(csv_path(name)).encode()
+
+
+def load_table(name, columns=None):
+    """Load a table from its snapshot, or from the CSV when the snapshot is missing or stale."""
+    if not is_fresh(name):
+        return read_csv(name, columns)
+    table = feather.read_table(snapshot_path(name), columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def build_all():
+    for filename in sorted(os.listdir(DATA_DIR)):
+        if filename.endswith('.csv'):
+            print(build_snapshot(filename[:-len('.csv')]))
+
+
+def _measure(mode):
+    import subprocess
+    import textwrap
+    loaders = {
+        'csv': "pd.read_csv('./Data/descriptive_stats.csv')",
+        'snapshot': "snapshot.load_table('descriptive_stats')",
+    }
+    code = textwrap.dedent('''
+        import resource, time
+        import pandas as pd
+        import snapshot
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        df = {loader}
+        elapsed = time.perf_counter() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('{mode:<9} load {{:8.2f}} ms   peak RSS {{:7.1f}} MB (+{{:.1f}} MB)   frame {{:7.2f}} MB'.format(
+            elapsed * 1000, peak / 1024, (peak - before) / 1024, df.memory_usage(deep=True).sum() / 2**20))
+    ''').format(loader=loaders[mode], mode=mode)
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == '__main__':
+    if '--measure' in sys.argv:
+        _measure('csv')
+        _measure('snapshot')
+    else:
+        build_all()